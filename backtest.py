@@ -1,7 +1,9 @@
 #!/home/mansuman/venv/bin/python
 import sys
+import time
 from pathlib import Path
 import argparse
+import numpy as np
 import pandas as pd
 from nsepy import get_history
 import logging
@@ -9,11 +11,154 @@ from datetime import date
 from datetime import datetime as dt
 from datetime import timedelta
 import sqlite3
+import queue
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from backtest_kernel import evaluate_buy, evaluate_sell, price_arrays
+import nse_fetch
+import nse_calendar
+from backtest_results import ResultsStore, params_key, RUN_DONE
+from backtest_stats import stats
+
+
+class BacktestError(Exception):
+    """
+    Raised when a single backtest cannot be completed (no data, download failure..).
+    Batch runners catch this per row instead of letting the process exit.
+    """
+    pass
+
+class SchemaError(Exception):
+    """
+    Raised when nsecache has a schema version we don't understand. Not a
+    BacktestError: no backtest can run until the cache is migrated.
+    """
+    pass
 
 
 """
 NSE Cache implementation BEGIN
 """
+def nsecache_table_sql(name):
+    """
+    Schema version 1 of the NSECACHE table.
+    Date is a day number (days since 1970-01-01). The table is clustered on
+    (Symbol, Date) (WITHOUT ROWID), so the rows of a symbol sit together on disk
+    in date order and a range read is one B-tree seek plus a sequential scan.
+    Version 0 had TEXT dates in a rowid table, see migrate_db().
+    """
+    return """
+    CREATE TABLE "{}" (
+      "Symbol" TEXT NOT NULL,
+      "Date" INTEGER NOT NULL,
+      "Series" TEXT,
+      "Prev Close" REAL,
+      "Open" REAL,
+      "High" REAL,
+      "Low" REAL,
+      "Last" REAL,
+      "Close" REAL,
+      "VWAP" REAL,
+      "Volume" INTEGER,
+      "Turnover" REAL,
+      "Trades" INTEGER,
+      "Deliverable Volume" INTEGER,
+      "%Deliverble" REAL,
+      PRIMARY KEY ("Symbol", "Date")
+    ) WITHOUT ROWID;
+    """.format(name)
+
+def date_to_day(d):
+    # Day number of a date, as stored in NSECACHE.Date
+    return (d - date(1970, 1, 1)).days
+
+def migrate_db(batch_size=200000):
+    """
+    Migrate a version 0 cache to the current schema, online: the rows are copied
+    into NSECACHE_NEW in batches of rowids, each batch in its own transaction, while
+    readers keep using the old table. Progress is kept in NSECACHE_MIGRATION, so an
+    interrupted migration carries on where it stopped. The last batch and the table
+    swap happen in one transaction. Duplicate (Symbol, Date) rows keep the latest one.
+    """
+    conn = sqlite3.connect(NSEDB.db_location, isolation_level=None)
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version == NSEDB.schema_version:
+        logging.info("nsecache is already at schema version {}".format(version))
+        conn.close()
+        return
+
+    columns = [c for c in NSECACHE_COLUMNS if c != "Date"]
+    names = ", ".join('"{}"'.format(c) for c in columns)
+    updates = ", ".join('"{0}" = excluded."{0}"'.format(c) for c in columns if c != "Symbol")
+    copy_cmd = """
+    INSERT INTO "NSECACHE_NEW" ("Date", {0})
+    SELECT CAST(julianday("Date") - 2440587.5 AS INTEGER), {0} FROM "NSECACHE" WHERE rowid > ? AND rowid <= ?
+    ON CONFLICT ("Symbol", "Date") DO UPDATE SET {1}
+    """.format(names, updates)
+
+    conn.execute("BEGIN")
+    if conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'NSECACHE_NEW'").fetchone() is None:
+        conn.execute(nsecache_table_sql("NSECACHE_NEW"))
+        conn.execute('CREATE TABLE "NSECACHE_MIGRATION" ("Last" INTEGER)')
+        conn.execute('INSERT INTO "NSECACHE_MIGRATION" VALUES (0)')
+    conn.execute("COMMIT")
+
+    last = conn.execute('SELECT "Last" FROM "NSECACHE_MIGRATION"').fetchone()[0]
+    total = conn.execute('SELECT COALESCE(MAX(rowid), 0) FROM "NSECACHE"').fetchone()[0]
+    logging.info("Migrating nsecache to schema version {}: rows {} to {}".format(NSEDB.schema_version, last, total))
+
+    start = time.perf_counter()
+    while last + batch_size < total:
+        conn.execute("BEGIN")
+        conn.execute(copy_cmd, (last, last + batch_size))
+        last += batch_size
+        conn.execute('UPDATE "NSECACHE_MIGRATION" SET "Last" = ?', (last,))
+        conn.execute("COMMIT")
+        logging.info("Migrated rows up to {} of {}".format(last, total))
+
+    # Rows written in the meantime go with the last batch, then swap the tables.
+    conn.execute("BEGIN IMMEDIATE")
+    conn.execute(copy_cmd, (last, 2 ** 62))
+    conn.execute('DROP TABLE "NSECACHE"')
+    conn.execute('ALTER TABLE "NSECACHE_NEW" RENAME TO "NSECACHE"')
+    conn.execute('DROP TABLE "NSECACHE_MIGRATION"')
+    conn.execute("PRAGMA user_version = {}".format(NSEDB.schema_version))
+    conn.execute("COMMIT")
+    conn.close()
+
+    logging.info("Migrated nsecache in {:.1f}s. Run VACUUM on {} to give the space of the old table back.".format(time.perf_counter() - start, NSEDB.db_location))
+
+# Missing trading days between two cached rows of a symbol which are still taken as
+# covered when seeding NSECACHE_COVERAGE, for the holidays a calendar without a
+# holidays file does not know about.
+COVERAGE_SEED_GAP_SESSIONS = 2
+
+def coverage_runs(df):
+    """
+    (Symbol, Start, End) of every run of consecutive cached dates of a frame of
+    Symbol and Date (day numbers) sorted by both. A run ends where more than
+    COVERAGE_SEED_GAP_SESSIONS trading days are missing before the next row.
+    """
+    if df.empty:
+        return []
+
+    calendar = nse_calendar.get_calendar()
+    symbols = df["Symbol"].to_numpy()
+    days = df["Date"].to_numpy(dtype='int64')
+    # Trading days before each day, so the difference counts the sessions in between
+    offsets = np.clip(days - calendar.first, 0, len(calendar.index) - 2)
+    before = calendar.index[offsets].astype('int64')
+    after = calendar.index[offsets + 1].astype('int64')
+    missing = before[1:] - after[:-1]
+
+    breaks = (symbols[1:] != symbols[:-1]) | (missing > COVERAGE_SEED_GAP_SESSIONS)
+    starts = np.concatenate(([0], np.flatnonzero(breaks) + 1))
+    ends = np.concatenate((starts[1:] - 1, [len(days) - 1]))
+    return [(symbols[i], nse_calendar.from_day_number(days[i]).isoformat(), nse_calendar.from_day_number(days[j]).isoformat())
+            for i, j in zip(starts, ends)]
+
 class NSEDB:
     instance = None
     db_name = "nsecache.db"
@@ -21,18 +166,34 @@ class NSEDB:
     # working_dir = home_dir + "/.nsecache/"
     working_dir = "./.nsecache/"
     db_location = working_dir + db_name
+    # Parallel batch workers only read the cache. Set this before the first NSEDB() call.
+    read_only = False
+    # PRAGMA user_version of the cache we understand, see nsecache_table_sql().
+    schema_version = 1
+    # Connection profile, applied to every connection we open. Set before the first NSEDB() call.
+    # journal_mode belongs to the database file, only the writer sets it.
+    profile = {
+        'journal_mode': 'WAL',          # readers and the writer don't block each other
+        'synchronous': 'NORMAL',        # safe with WAL, fsync only at checkpoints
+        'cache_size': -64 * 1024,       # negative means KiB, per connection
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+    }
+    # Seconds to wait on a lock before giving up with "database is locked"
+    busy_timeout = 30
+    # Read-only connections per process, see read()
+    read_pool_size = 4
 
     def __new__(cls, *args, **kwargs):
         logging.debug("__new__ Enter")
         if cls.instance is None:
             logging.info("Creating new NSEDB instance")
-            cls.instance = super().__new__(NSEDB)
 
             """
             This is our first time. Lets setup NSE cache.
             Initialize the NSE cache.
             """
-            if Path(cls.working_dir).is_dir() is False:
+            if Path(cls.working_dir).is_dir() is False and not cls.read_only:
                 logging.info("Creating nsecache directory...")
                 # Create cache directory
                 """
@@ -47,150 +208,630 @@ class NSEDB:
                     p = Path(cls.working_dir)
                     p.mkdir(parents=True, exist_ok=True)
                 except Exception as e:
-                    logging.err("Could not create cache dir: {}".str(e))
+                    logging.error("Could not create cache dir: {}".format(str(e)))
                     sys.exit(0)
 
-                logging.info("Creating cache database...")
-                try:
-                    conn = sqlite3.connect(cls.db_location)
-                except sqlite3.Error as e:
-                    logging.error("Sqlite connect error: {}".format(str(e)))
-                    logging.info("Deleting cache dir")
-                    os.rmdir(cls.working_dir)
-                    sys.exit(0)
+            try:
+                conn = cls.connect(cls.read_only)
+            except sqlite3.Error as e:
+                logging.error("Sqlite connect error: {}".format(str(e)))
+                sys.exit(0)
 
+            c = conn.cursor()
+            c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'NSECACHE'")
+            if c.fetchone() is None and not cls.read_only:
                 # Create an empty table
-                cmd_1 = """ 
-                CREATE TABLE IF NOT EXISTS "NSECACHE" (
-                "Date" DATE,
-                  "Symbol" TEXT,
-                  "Series" TEXT,
-                  "Prev Close" REAL,
-                  "Open" REAL,
-                  "High" REAL,
-                  "Low" REAL,
-                  "Last" REAL,
-                  "Close" REAL,
-                  "VWAP" REAL,
-                  "Volume" INTEGER,
-                  "Turnover" REAL,
-                  "Trades" INTEGER,
-                  "Deliverable Volume" INTEGER,
-                  "%Deliverble" REAL
-                );
-                """
-                cmd_2 = """
-                CREATE INDEX "ix_NSECACHE_Date"ON "NSECACHE" ("Date");
-                """
-
                 logging.info("Creating empty table NSECACHE...")
-                c = conn.cursor()
-                c.execute(cmd_1)
-                c.execute(cmd_2)
+                c.execute(nsecache_table_sql("NSECACHE"))
+                c.execute("PRAGMA user_version = {}".format(cls.schema_version))
                 conn.commit()
 
+            # Check we understand this cache
+            version = c.execute("PRAGMA user_version").fetchone()[0]
+            c.close()
+            conn.close()
+            if version != cls.schema_version:
+                raise SchemaError("nsecache schema version is {}, we need {}. Run ./backtest.py --migrate_db first.".format(version, cls.schema_version))
+
+            cls.instance = super().__new__(NSEDB)
+
         return cls.instance
 
     def __init__(self):
         logging.debug("__init__ Enter")
-        self.conn = self.connect()
-        self.cursor = self.conn.cursor()
-
-    def connect(self):
+        if getattr(self, 'readers', None) is not None:
+            # Singleton: keep using the connections we already have.
+            return
+        self.readers = queue.LifoQueue()
+        self.reader_count = 0
+        self.reader_lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        # The one writer connection. None when the cache is opened read-only.
+        self.conn = None if self.read_only else self.connect(False)
+        if not self.read_only:
+            self.ensure_coverage_table()
+
+    @classmethod
+    def connect(cls, read_only):
         logging.debug("connect Enter")
+        if read_only:
+            conn = sqlite3.connect("file:{}?mode=ro".format(cls.db_location), uri=True, timeout=cls.busy_timeout, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(cls.db_location, timeout=cls.busy_timeout, check_same_thread=False)
+
+        for name, value in cls.profile.items():
+            if name == 'journal_mode' and read_only:
+                continue
+            conn.execute("PRAGMA {} = {}".format(name, value))
+
+        return conn
+
+    @contextmanager
+    def read(self):
+        """
+        A read-only connection from the pool, given back on exit. Opens up to
+        read_pool_size of them; after that waits for one to come back.
+        """
+        try:
+            conn = self.readers.get_nowait()
+        except queue.Empty:
+            with self.reader_lock:
+                can_open = self.reader_count < self.read_pool_size
+                if can_open:
+                    self.reader_count += 1
+            conn = self.connect(True) if can_open else self.readers.get()
+
         try:
-            return sqlite3.connect(self.db_location)
-        except sqlite3.Error as e:
-            logging.error("Sqlite connect error: ({}) {}".format(self.db_location, str(e)))
+            yield conn
+        finally:
+            self.readers.put(conn)
+
+    @contextmanager
+    def write(self):
+        """
+        The writer connection, for one user at a time, in a transaction which is
+        committed on exit (rolled back on an exception).
+        """
+        if self.conn is None:
+            raise sqlite3.OperationalError("nsecache is open read-only")
+
+        with self.write_lock:
+            with self.conn:
+                yield self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        while True:
+            try:
+                self.readers.get_nowait().close()
+            except queue.Empty:
+                break
+        self.reader_count = 0
+
+    def ensure_coverage_table(self):
+        """
+        Create NSECACHE_COVERAGE, see get_coverage(). Symbols cached before we had
+        it are taken as covered over each run of consecutive cached dates, see
+        coverage_runs(), so the holes they already have still get fetched.
+        A table from before the "Checked" column gets it, see record_checked().
+        """
+        with self.write() as conn:
+            if conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'NSECACHE_COVERAGE'").fetchone() is not None:
+                columns = [row[1] for row in conn.execute('PRAGMA table_info("NSECACHE_COVERAGE")')]
+                if "Checked" not in columns:
+                    conn.execute('ALTER TABLE "NSECACHE_COVERAGE" ADD COLUMN "Checked" DATE')
+                return
+
+            logging.info("Creating table NSECACHE_COVERAGE...")
+            conn.execute("""
+            CREATE TABLE "NSECACHE_COVERAGE" (
+              "Symbol" TEXT,
+              "Start" DATE,
+              "End" DATE,
+              "Checked" DATE,
+              PRIMARY KEY ("Symbol", "Start")
+            );
+            """)
+            conn.execute("""
+            CREATE INDEX "ix_NSECACHE_COVERAGE_Symbol_End" ON "NSECACHE_COVERAGE" ("Symbol", "End");
+            """)
+            df = pd.read_sql_query('SELECT "Symbol", "Date" FROM "NSECACHE" ORDER BY "Symbol", "Date"', conn)
+            conn.executemany('INSERT INTO "NSECACHE_COVERAGE" ("Symbol", "Start", "End") VALUES (?, ?, ?)', coverage_runs(df))
+
+    @classmethod
+    def reset(cls):
+        """
+        Close the connections and forget the instance. The next NSEDB() connects again.
+        """
+        if cls.instance is not None:
+            cls.instance.close()
+        cls.instance = None
 
     def __del__(self):
         print("__del__ Enter")
         try:
-            self.cursor.close()
-            self.conn.close()
+            self.close()
         except:
             pass
 
-def get_nse_history_from_cache(symbol, start, end):
-    start_date = dt.strptime(start, '%d-%m-%Y').date()
-    end_date = dt.strptime(end, '%d-%m-%Y').date()
+NSECACHE_COLUMNS = ["Date", "Symbol", "Series", "Prev Close", "Open", "High", "Low", "Last", "Close",
+        "VWAP", "Volume", "Turnover", "Trades", "Deliverable Volume", "%Deliverble"]
+
+def upsert_nse_history(data_df):
+    """
+    Write a get_history() frame (indexed by Date) into NSECACHE.
+    Rows already in the cache for the same (Symbol, Date) are updated, so fetching
+    an overlapping range again does not add rows. Everything goes in one transaction.
+    Returns the number of rows written.
+    """
+    if data_df.empty:
+        return 0
 
+    df = data_df.reset_index()
+    df['Date'] = pd.to_datetime(df['Date']).to_numpy(dtype='datetime64[D]').astype('int64')
+    columns = [c for c in NSECACHE_COLUMNS if c in df.columns]
 
-    start_date_str = start_date.strftime('%Y-%m-%d')
-    end_date_str = end_date.strftime('%Y-%m-%d')
+    # tolist() gives plain python ints/floats, which is what sqlite3 can bind.
+    rows = list(zip(*[df[c].tolist() for c in columns]))
 
-    query = "SELECT * FROM NSECACHE WHERE Symbol = '%s' AND Date BETWEEN '%s' AND '%s'" %(symbol, start_date_str, end_date_str)
+    names = ", ".join('"{}"'.format(c) for c in columns)
+    params = ", ".join("?" for c in columns)
+    updates = ", ".join('"{0}" = excluded."{0}"'.format(c) for c in columns if c not in ("Symbol", "Date"))
+    cmd = 'INSERT INTO "NSECACHE" ({}) VALUES ({}) ON CONFLICT ("Symbol", "Date") DO UPDATE SET {}'.format(names, params, updates)
 
     db_instance = NSEDB()
-    df = pd.read_sql_query(query, db_instance.conn)
+    with db_instance.write() as conn:
+        conn.executemany(cmd, rows)
+
+    return len(rows)
+
+class PriceCache:
+    """
+    In-process LRU cache of the parsed price history of symbols: all cached rows of
+    a symbol, indexed by a DatetimeIndex. Holds at most max_bytes (0 turns it off);
+    least recently used symbols are evicted first. write_nse_history() invalidates
+    the symbols it writes.
+    Frames handed out share memory with the cache, don't modify them.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, symbol, loader):
+        """
+        History of symbol, loaded with loader(symbol) if we don't have it.
+        """
+        if symbol in self.entries:
+            self.hits += 1
+            stats.count('price_cache_hits')
+            self.entries.move_to_end(symbol)
+            return self.entries[symbol][0]
+
+        self.misses += 1
+        stats.count('price_cache_misses')
+        with stats.stage('price_cache_load'):
+            df = loader(symbol)
+        nbytes = int(df.memory_usage(deep=True).sum())
+        if nbytes > self.max_bytes:
+            return df
+
+        while self.size + nbytes > self.max_bytes:
+            evicted, (evicted_df, evicted_bytes) = self.entries.popitem(last=False)
+            self.size -= evicted_bytes
+            self.evictions += 1
+            stats.count('price_cache_evictions')
+
+        self.entries[symbol] = (df, nbytes)
+        self.size += nbytes
+        return df
+
+    def invalidate(self, symbol):
+        if symbol in self.entries:
+            df, nbytes = self.entries.pop(symbol)
+            self.size -= nbytes
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        return {'symbols': len(self.entries), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+price_cache = PriceCache(max_bytes=256 * 1024 * 1024)
+
+def slice_by_date(df, start_date, end_date):
+    """
+    Rows of a Date indexed (sorted) frame from start_date to end_date, both included.
+    A positional slice, no copy.
+    """
+    i = df.index.searchsorted(pd.Timestamp(start_date), side='left')
+    j = df.index.searchsorted(pd.Timestamp(end_date), side='right')
+    return df.iloc[i:j]
+
+"""
+Price history stores.
+A store keeps the bars of every symbol and has two methods:
+    read_symbol(symbol, columns=None) -> all rows of symbol, indexed by Date
+    write(data_df) -> upsert a get_history() frame, returns the number of rows
+SqliteStore (the NSECACHE table) is the default. nsecache_parquet.ParquetStore keeps
+one columnar file per symbol, nsecache_mmap.MmapStore is a read-only memory-mapped
+OHLCV copy. The coverage table always stays in nsecache.db.
+"""
+class SqliteStore:
+    name = 'sqlite'
+
+    def read_symbol(self, symbol, columns=None):
+        return query_nse_cache(symbol, columns)
+
+    def write(self, data_df):
+        return upsert_nse_history(data_df)
+
+    def read_panel(self, symbols, fields, start_date, end_date):
+        return query_nse_panel(symbols, fields, start_date, end_date)
+
+    def invalidate(self, symbol):
+        # Every read is a query, there is nothing to forget.
+        pass
+
+store = SqliteStore()
+
+def use_store(name):
+    """
+    Switch the price history store: 'sqlite', 'parquet', 'feather' or 'mmap'.
+    """
+    global store
+    if name == 'sqlite':
+        store = SqliteStore()
+    elif name in ('parquet', 'feather'):
+        from nsecache_parquet import ParquetStore
+        store = ParquetStore(format=name)
+    elif name == 'mmap':
+        from nsecache_mmap import MmapStore
+        store = MmapStore()
+    else:
+        raise ValueError("Unknown store {}".format(name))
+
+    price_cache.clear()
+
+def write_nse_history(data_df):
+    """
+    Write a get_history() frame to the store and drop the symbols from price_cache.
+    """
+    with stats.stage('cache_write'):
+        rows = store.write(data_df)
+    stats.count('rows_written', rows)
+
+    if not data_df.empty:
+        for symbol in data_df['Symbol'].unique():
+            price_cache.invalidate(symbol)
+
+    return rows
+
+def invalidate_symbol(symbol):
+    """
+    Forget what this process has read of symbol, after another process (the
+    parent of a batch worker) has written to its history.
+    """
+    price_cache.invalidate(symbol)
+    store.invalidate(symbol)
+
+# Integer columns which we store in the smallest integer type that holds them.
+NSECACHE_COUNT_COLUMNS = ["Volume", "Trades", "Deliverable Volume"]
+
+def query_nse_cache(symbol, columns=None, start_date=None, end_date=None):
+    """
+    Rows of symbol from NSECACHE between start_date and end_date (both optional,
+    included), indexed by a DatetimeIndex and sorted by Date.
+    columns selects the columns to read (default all of them). The statement only
+    has bound parameters, so sqlite3 reuses it from its statement cache.
+    Symbol/Series come back as categoricals, the count columns downcast.
+    """
+    if columns is None:
+        columns = NSECACHE_COLUMNS
+    columns = ["Date"] + [c for c in columns if c != "Date"]
+    names = ", ".join('"{}"'.format(c) for c in columns)
+
+    start_day = date_to_day(start_date) if start_date is not None else -2 ** 31
+    end_day = date_to_day(end_date) if end_date is not None else 2 ** 31
+
+    query = 'SELECT {} FROM "NSECACHE" WHERE "Symbol" = ? AND "Date" BETWEEN ? AND ? ORDER BY "Date"'.format(names)
+
+    db_instance = NSEDB()
+    with stats.stage('sql_read'), db_instance.read() as conn:
+        df = pd.read_sql_query(query, conn, params=(symbol, start_day, end_day))
+    stats.count('rows_read', len(df))
+
+    with stats.stage('to_frame'):
+        df.index = pd.DatetimeIndex(df.pop('Date').to_numpy(dtype='int64').astype('datetime64[D]'), name='Date')
+        for c in df.columns:
+            if c in ("Symbol", "Series"):
+                df[c] = df[c].astype('category')
+            elif c in NSECACHE_COUNT_COLUMNS:
+                df[c] = pd.to_numeric(df[c], downcast='integer')
 
     return df
 
-def get_nse_history(symbol, start, end):
+@stats.timed('get_nse_history_from_cache')
+def get_nse_history_from_cache(symbol, start, end, columns=None):
     """
-    First check if we have the data in our cache. If we have it, return it.
-    Else, fetch the data from NSE India site, update the cache and return it.
-    Hack: We always query one week more data than the end date.
-    Note: We expect date to be a string in dd-mm-yyyy format.
+    Cached rows of symbol from start to end (dd-mm-yyyy), see query_nse_cache().
     """
     start_date = dt.strptime(start, '%d-%m-%Y').date()
     end_date = dt.strptime(end, '%d-%m-%Y').date()
 
-    # Sanitize dates
-    if end_date < start_date:
-        # Return empty dataframe
-        return pd.DataFrame()
+    return query_nse_cache(symbol, columns, start_date, end_date)
 
-    # Fetch one week before and after the requested start and end date
-    start_date_fetch = start_date - timedelta(weeks=1)
-    end_date_fetch = end_date + timedelta(weeks=1)
-    df = get_nse_history_from_cache(symbol, start_date_fetch.strftime('%d-%m-%Y'), end_date_fetch.strftime('%d-%m-%Y'))
+"""
+Coverage of the cache.
+NSECACHE_COVERAGE holds, per symbol, the date intervals we have already asked NSE
+for. Days in a covered interval without a row in NSECACHE are holidays/weekends,
+not holes. Intervals of a symbol never overlap or touch: record_coverage() merges
+them. With the (Symbol, End) index, finding the intervals around a date range is
+one index seek.
+Today's session is only covered once NSE has published it. Until then, the last
+interval of the symbol has the day we last asked for it in "Checked", so we ask
+once a day, not on every get_nse_history(). ./backtest.py --update_db asks again.
+"""
+def get_coverage(symbol, start_date, end_date):
+    """
+    Covered intervals of symbol which overlap [start_date, end_date], in date order.
+    """
+    db_instance = NSEDB()
+    with db_instance.read() as conn:
+        rows = conn.execute(
+                'SELECT "Start", "End" FROM "NSECACHE_COVERAGE" WHERE "Symbol" = ? AND "End" >= ? AND "Start" <= ? ORDER BY "End"',
+                (symbol, start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))).fetchall()
 
-    print(df)
+    return [(dt.strptime(s, '%Y-%m-%d').date(), dt.strptime(e, '%Y-%m-%d').date()) for s, e in rows]
 
-    # Check if dataframe is empty
-    if df.empty:
-        #Fetch data from 2017 till today.
-        from_date = dt.strptime('01-01-2017', '%d-%m-%Y').date()
-        to_date = date.today()
+def is_symbol_covered(symbol):
+    db_instance = NSEDB()
+    with db_instance.read() as conn:
+        row = conn.execute('SELECT 1 FROM "NSECACHE_COVERAGE" WHERE "Symbol" = ? LIMIT 1', (symbol,)).fetchone()
+    return row is not None
 
-        try:
-            data_df = get_history(symbol=symbol, start=from_date, end=to_date)
-        except Exception as e:
-            logging.error("Failed to download data for symbol {}: {}".format(symbol, str(e)))
-            sys.exit(0)
+def missing_ranges(symbol, start_date, end_date):
+    """
+    The parts of [start_date, end_date] that were never fetched, as a list of (from, to) dates.
+    """
+    ranges = []
+    next_date = start_date
+    for covered_start, covered_end in get_coverage(symbol, start_date, end_date):
+        if covered_start > next_date:
+            ranges.append((next_date, covered_start - timedelta(days=1)))
+        next_date = max(next_date, covered_end + timedelta(days=1))
 
-        try:
-            db_instance = NSEDB()
-            data_df.to_sql('NSECACHE', db_instance.conn, if_exists='append', index = True)
-        except Exception as e:
-            logging.error("{}".format(str(e)))
+    if next_date <= end_date:
+        ranges.append((next_date, end_date))
+
+    return ranges
+
+def record_coverage(symbol, start_date, end_date):
+    """
+    Mark [start_date, end_date] as fetched, merging it with the intervals it overlaps or touches.
+    """
+    db_instance = NSEDB()
+    with db_instance.write() as conn:
+        rows = conn.execute(
+                'SELECT "Start", "End", "Checked" FROM "NSECACHE_COVERAGE" WHERE "Symbol" = ? AND "End" >= ? AND "Start" <= ?',
+                (symbol, (start_date - timedelta(days=1)).strftime('%Y-%m-%d'), (end_date + timedelta(days=1)).strftime('%Y-%m-%d'))).fetchall()
 
-        # We have updated the cache. Now loop over again to get the data from cache.
-        df = get_nse_history_from_cache(symbol, start, end_date_fetch.strftime('%d-%m-%Y'))
+        start_str = min([start_date.strftime('%Y-%m-%d')] + [s for s, e, c in rows])
+        end_str = max([end_date.strftime('%Y-%m-%d')] + [e for s, e, c in rows])
+        checked = max([c for s, e, c in rows if c is not None], default=None)
 
-    if not df.empty:
-        df.set_index('Date', inplace=True)
-        df.index = pd.to_datetime(df.index)
-        # Prune the dataframe to fit between start date and end date.
-        # Does not yet work: mask = (df.index >= start_date) & (df.index <= end_date)
-        # df = df.loc[mask]
-        # df = df.loc[start_date.strftime('%Y-%m-%d'): (end_date + timedelta(days=1)).strftime('%Y-%m-%d')]
+        conn.executemany('DELETE FROM "NSECACHE_COVERAGE" WHERE "Symbol" = ? AND "Start" = ?', [(symbol, s) for s, e, c in rows])
+        conn.execute('INSERT INTO "NSECACHE_COVERAGE" ("Symbol", "Start", "End", "Checked") VALUES (?, ?, ?, ?)', (symbol, start_str, end_str, checked))
 
-        df = df.loc[start_date.strftime('%Y-%m-%d'): end_date.strftime('%Y-%m-%d')]
+def record_checked(symbol, day):
+    """
+    Note on the last interval of symbol that we asked NSE for day, which was not published yet.
+    """
+    db_instance = NSEDB()
+    with db_instance.write() as conn:
+        conn.execute(
+                'UPDATE "NSECACHE_COVERAGE" SET "Checked" = ? WHERE "Symbol" = ? AND "Start" = '
+                '(SELECT MAX("Start") FROM "NSECACHE_COVERAGE" WHERE "Symbol" = ? AND "Start" <= ?)',
+                (day.strftime('%Y-%m-%d'), symbol, symbol, day.strftime('%Y-%m-%d')))
 
-    return df
+def checked_on(symbol, day):
+    """
+    True if we already asked NSE for day of symbol, see record_checked().
+    """
+    db_instance = NSEDB()
+    with db_instance.read() as conn:
+        row = conn.execute('SELECT 1 FROM "NSECACHE_COVERAGE" WHERE "Symbol" = ? AND "Checked" = ? LIMIT 1',
+                (symbol, day.strftime('%Y-%m-%d'))).fetchone()
+    return row is not None
 
-def get_nse_history_1(symbol, start, end):
+def download_nse_history(symbol, from_date, to_date):
+    """
+    get_history() for [from_date, to_date], rate limited and retried (see nse_fetch).
+    Raises BacktestError if the download fails.
+    """
+    logging.info("Fetch data from NSE for %s from %s to %s" % (symbol, from_date.strftime("%Y-%m-%d"), to_date.strftime("%Y-%m-%d")))
+
+    with stats.stage('download'):
+        result = nse_fetch.fetch_one(symbol, from_date, to_date, source=get_history)
+    stats.count('fetches')
+    if not result.ok:
+        stats.count('fetch_failures')
+        raise BacktestError("Failed to download data for symbol {}".format(symbol)) from result.error
+
+    return result.data_df
+
+def covered_until(data_df, to_date):
+    """
+    Last date a download up to to_date covers. Today's session only counts as
+    covered once NSE has published it.
+    """
+    today = date.today()
+    if to_date >= today and nse_calendar.get_calendar().is_trading_day(today) and today not in set(pd.to_datetime(data_df.index).date):
+        return today - timedelta(days=1)
+
+    return to_date
+
+def fetch_nse_history(symbol, from_date, to_date):
+    """
+    Download [from_date, to_date] from NSE into the cache and record it as covered.
+    """
+    data_df = download_nse_history(symbol, from_date, to_date)
+
+    try:
+        write_nse_history(data_df)
+    except Exception as e:
+        logging.error("{}".format(str(e)))
+        return
+
+    covered_to = covered_until(data_df, to_date)
+    if covered_to >= from_date:
+        record_coverage(symbol, from_date, covered_to)
+    if covered_to < to_date:
+        record_checked(symbol, date.today())
+
+def last_fetched_dates():
+    """
+    Every symbol in the cache with the last date we have fetched it up to.
+    """
+    db_instance = NSEDB()
+    with db_instance.read() as conn:
+        rows = conn.execute('SELECT "Symbol", MAX("End") FROM "NSECACHE_COVERAGE" GROUP BY "Symbol" ORDER BY "Symbol"').fetchall()
+
+    return [(symbol, dt.strptime(end, '%Y-%m-%d').date()) for symbol, end in rows]
+
+def store_fetched(results):
+    """
+    Write the successful nse_fetch.FetchResults to the cache in one transaction
+    and record their coverage after that.
+    Returns the number of rows written and {symbol: error} of the failed ones.
+    """
+    frames = []
+    fetched = []
+    failed = {}
+    for result in results:
+        stats.add('download', result.elapsed)
+        stats.count('fetches')
+        if not result.ok:
+            stats.count('fetch_failures')
+            failed[result.symbol] = result.error
+            continue
+        frames.append(result.data_df)
+        fetched.append((result.symbol, result.from_date, result.to_date, covered_until(result.data_df, result.to_date)))
+
+    rows = 0
+    frames = [f for f in frames if not f.empty]
+    if frames:
+        rows = write_nse_history(pd.concat(frames))
+
+    for symbol, from_date, to_date, covered_to in fetched:
+        if covered_to >= from_date:
+            record_coverage(symbol, from_date, covered_to)
+        if covered_to < to_date:
+            record_checked(symbol, date.today())
+
+    return rows, failed
+
+def fetch_ranges(requests, batch_size=50, workers=nse_fetch.FETCH_WORKERS):
+    """
+    Download a list of (symbol, from_date, to_date) concurrently (nse_fetch.fetch_many)
+    and write them to the cache batch_size at a time.
+    Returns {symbol: error} of the downloads that failed.
+    """
+    rows = 0
+    failed = {}
+    start = time.perf_counter()
+    for i in range(0, len(requests), batch_size):
+        results = nse_fetch.fetch_many(requests[i:i + batch_size], source=get_history, workers=workers)
+        batch_rows, batch_failed = store_fetched(results)
+        rows += batch_rows
+        failed.update(batch_failed)
+
+        elapsed = time.perf_counter() - start
+        logging.info("Fetched {} of {} ranges: {} rows, {:.0f} rows/s".format(min(i + batch_size, len(requests)), len(requests), rows, rows / elapsed if elapsed > 0 else 0))
+
+    elapsed = time.perf_counter() - start
+    logging.info("Fetch done in {:.1f}s: {} rows ({:.0f} rows/s), {} failed".format(elapsed, rows, rows / elapsed if elapsed > 0 else 0, len(failed)))
+    for symbol, error in failed.items():
+        logging.error("Failed to download data for symbol {}: {}".format(symbol, str(error)))
+
+    return failed
+
+def update_db(batch_size=50):
+    """
+    Bring every cached symbol up to today, fetching only what is new since its
+    last fetched date. The downloads of batch_size symbols are written in one
+    transaction; their coverage is recorded after that. A killed update just
+    starts again from where each symbol got to.
+    """
+    today = date.today()
+    calendar = nse_calendar.get_calendar()
+    # Symbols whose last fetch was before the last session. Holidays and weekends have nothing to fetch.
+    todo = [(symbol, last + timedelta(days=1), today) for symbol, last in last_fetched_dates()
+            if last < today and calendar.trim(last + timedelta(days=1), today) is not None]
+    logging.info("Updating {} symbols up to {}".format(len(todo), today))
+
+    fetch_ranges(todo, batch_size)
+
+def plan_fetch(symbol, start_date, end_date):
+    """
+    The (from_date, to_date) ranges get_nse_history() downloads before it can
+    serve [start_date, end_date] of symbol from the cache.
+    Ranges are trimmed to trading days (see nse_calendar), so a hole in the
+    coverage which is only weekends and holidays is not fetched. Nor is today's
+    session alone if NSE did not have it when we last asked today, see record_checked().
+    """
+    calendar = nse_calendar.get_calendar()
+
+    if is_symbol_covered(symbol):
+        # Fetch only what is missing. NSE has nothing after today.
+        ranges = missing_ranges(symbol, start_date, min(end_date, date.today()))
+    else:
+        # First time for this symbol. Fetch data from 2017 till today.
+        from_date = min(dt.strptime('01-01-2017', '%d-%m-%Y').date(), start_date)
+        ranges = [(from_date, date.today())]
+
+    ranges = [r for r in (calendar.trim(from_date, to_date) for from_date, to_date in ranges) if r is not None]
+    today = date.today()
+    if ranges and ranges[-1] == (today, today) and checked_on(symbol, today):
+        ranges.pop()
+    return ranges
+
+def prefetch(spans, batch_size=50, workers=nse_fetch.FETCH_WORKERS):
+    """
+    Fill the cache for a list of (symbol, start, end) (dd-mm-yyyy) with concurrent
+    downloads, so that get_nse_history() finds them all cached.
+    Returns the set of symbols it downloaded for and {symbol: error} of the downloads that failed.
+    """
+    requests = []
+    for symbol, start, end in spans:
+        start_date = dt.strptime(start, '%d-%m-%Y').date()
+        end_date = dt.strptime(end, '%d-%m-%Y').date()
+        requests.extend((symbol, from_date, to_date) for from_date, to_date in plan_fetch(symbol, start_date, end_date))
+
+    if not requests:
+        return set(), {}
+
+    logging.info("Prefetching {} ranges for {} symbols".format(len(requests), len(spans)))
+    return {symbol for symbol, from_date, to_date in requests}, fetch_ranges(requests, batch_size, workers)
+
+# {symbol: error} of the downloads a batch gave up on, see process_backtest_data_file.batch_tasks().
+# get_nse_history() does not try them again until the batch clears this.
+failed_fetches = {}
+
+@stats.timed('get_nse_history')
+def get_nse_history(symbol, start, end):
     """
     First check if we have the data in our cache. If we have it, return it.
-    Else, fetch the data from NSE India site, update the cache and return it.
-    Hack: We always query one week more data than the end date.
+    Else, fetch the missing date ranges from NSE India site, update the cache and return it.
+    Only trading days are fetched, see plan_fetch().
     Note: We expect date to be a string in dd-mm-yyyy format.
     """
-    fetch_from_nse = False
-    from_date = None
-
     start_date = dt.strptime(start, '%d-%m-%Y').date()
     end_date = dt.strptime(end, '%d-%m-%Y').date()
 
@@ -199,101 +840,181 @@ def get_nse_history_1(symbol, start, end):
         # Return empty dataframe
         return pd.DataFrame()
 
-    # Fetch one week before and after the requested start and end date
-    start_date_fetch = start_date - timedelta(weeks=1)
-    end_date_fetch = end_date + timedelta(weeks=1)
-    df = get_nse_history_from_cache(symbol, start_date_fetch.strftime('%d-%m-%Y'), end_date_fetch.strftime('%d-%m-%Y'))
+    # A read-only process (a batch worker) can not add to the cache, it serves what is there.
+    if not NSEDB.read_only:
+        with stats.stage('plan_fetch'):
+            ranges = plan_fetch(symbol, start_date, end_date)
+        # A hit when the cache already covers the whole range, a miss when it has to fetch.
+        stats.count('cache_misses' if ranges else 'cache_hits')
+        if ranges and symbol in failed_fetches:
+            raise BacktestError("Download of {} failed earlier: {}".format(symbol, failed_fetches[symbol]))
+        for from_date, to_date in ranges:
+            fetch_nse_history(symbol, from_date, to_date)
 
-    # Check if dataframe is empty
-    if df.empty:
-        fetch_from_nse = True
-        from_date = start_date
-    else:
-        # Check if dataframe is incomplete
-        # 1) We should get at least one entry which has date more than end_date
-        # Otherwise, check the last date date and fetch from there.
-        last_date_str = df.iloc[-1].Date
-        last_date = dt.strptime(last_date_str, '%Y-%m-%d').date()
-
-        if last_date < end_date:
-            fetch_from_nse = True
-            from_date = last_date + timedelta(days=1)
-            logging.info("We have data till %s. Fetch from NSE." % last_date_str)
-
-        # 2) The first frame date should be equal to the start date
-        first_date_str = df.iloc[0].Date
-        first_date = dt.strptime(first_date_str, '%Y-%m-%d').date()
-        if first_date > start_date:
-            fetch_from_nse = True
-            from_date = start_date_fetch
-            logging.info("We have data from %s. Fetch from NSE." % first_date_str)
-
-    if fetch_from_nse is True:
-        # Fetch data from NSE. We fetch a minimum of 7 months of data in one query.
-        # to_date = from_date + timedelta(weeks=30)
-        to_date = end_date_fetch
-
-        if end_date > to_date:
-            to_date = end_date
-
-        if to_date > date.today():
-            to_date = date.today()
-
-        if from_date == date.today():
-            # If today is a weekend, return.
-            weekno = dt.today().weekday()
-            # Monday = 0, Friday = 4
-            if weekno > 4:
-                if not df.empty:
-                    df.set_index('Date', inplace=True)
-                    df.index = pd.to_datetime(df.index)
-                    # Prune the dataframe to fit between start date and end date.
-                    # Does not yet work: mask = (df.index >= start_date) & (df.index <= end_date)
-                    # df = df.loc[mask]
-                    # df = df.loc[start_date.strftime('%Y-%m-%d'): (end_date + timedelta(days=1)).strftime('%Y-%m-%d')]
-
-                    df = df.loc[start_date.strftime('%Y-%m-%d'): end_date.strftime('%Y-%m-%d')]
-                    return df
-                
-
-        # Fetch data from before 2 weeks of start date.
-        from_date = from_date - timedelta(weeks=2)
-
-        logging.info("Fetch data from NSE for %s from %s to %s" % (symbol, from_date.strftime("%Y-%m-%d"), to_date.strftime("%Y-%m-%d")))
+    # The whole history of the symbol is parsed once and kept in price_cache.
+    df = price_cache.get(symbol, store.read_symbol)
 
-        try:
-            data_df = get_history(symbol=symbol, start=from_date, end=to_date)
-        except Exception as e:
-            logging.error("Failed to download data for symbol {}: {}".format(symbol, str(e)))
-            sys.exit(0)
+    # Prune the dataframe to fit between start date and end date.
+    return slice_by_date(df, start_date, end_date)
 
-        try:
-            db_instance = NSEDB()
-            data_df.to_sql('NSECACHE', db_instance.conn, if_exists='append', index = True)
-        except Exception as e:
-            logging.error("{}".format(str(e)))
+class SymbolHistory:
+    """
+    Cached history of one symbol over the span of many signals, read from the cache once.
+    window() then gives the same frame get_nse_history() would return for any range
+    inside the span, as a positional slice of the frame already in memory.
+    The span is loaded on the first window() call, so skipped symbols cost nothing.
+    """
+    def __init__(self, symbol, start, end):
+        self.symbol = symbol
+        self.start = start
+        self.end = end
+        self.df = None
+        self.error = None
+
+    def load(self):
+        if self.error is not None:
+            raise self.error
+        if self.df is None:
+            try:
+                self.df = get_nse_history(self.symbol, self.start, self.end)
+            except BacktestError as e:
+                self.error = e
+                raise
+
+    def window(self, start, end):
+        self.load()
+        return slice_by_date(self.df, dt.strptime(start, '%d-%m-%Y'), dt.strptime(end, '%d-%m-%Y'))
+
+def get_nse_history_sessions(symbol, start, sessions):
+    """
+    The first sessions trading days of symbol on or after start (dd-mm-yyyy).
+    """
+    start_date = dt.strptime(start, '%d-%m-%Y').date()
+    end_date = nse_calendar.get_calendar().add_sessions(start_date, sessions - 1)
+    return get_nse_history(symbol, start, end_date.strftime('%d-%m-%Y'))
+
+def get_nse_history_1(symbol, start, end):
+    """
+    Used to find holes by comparing the first/last cached dates with the request.
+    The coverage table does that now, see get_nse_history().
+    """
+    return get_nse_history(symbol, start, end)
 
-        # We have updated the cache. Now loop over again to get the data from cache.
-        df = get_nse_history_from_cache(symbol, start, end_date_fetch.strftime('%d-%m-%Y'))
+"""
+Panels.
+A panel is the history of many symbols over one date range as one (date x
+symbol) array per field, so that a kernel can evaluate a whole cross-section at
+once. In nsecache.db the symbols go into a temp table which is joined with
+NSECACHE: one indexed query for all symbols, whatever their number. The dates
+of a panel are the days on which at least one of its symbols traded; a symbol
+without a row on one of them has NaN there.
+"""
+PANEL_FIELDS = ["Open", "High", "Low", "Close", "Volume"]
 
-    if not df.empty:
-        df.set_index('Date', inplace=True)
-        df.index = pd.to_datetime(df.index)
-        # Prune the dataframe to fit between start date and end date.
-        # Does not yet work: mask = (df.index >= start_date) & (df.index <= end_date)
-        # df = df.loc[mask]
-        # df = df.loc[start_date.strftime('%Y-%m-%d'): (end_date + timedelta(days=1)).strftime('%Y-%m-%d')]
+class Panel:
+    """
+    dates (datetime64[D]), symbols, and per field a float64 array of
+    len(dates) x len(symbols), NaN where the symbol has no row.
+    """
+    def __init__(self, dates, symbols, fields):
+        self.dates = dates
+        self.symbols = symbols
+        self.fields = fields
 
-        df = df.loc[start_date.strftime('%Y-%m-%d'): end_date.strftime('%Y-%m-%d')]
+    def __getitem__(self, field):
+        return self.fields[field]
 
+    def frame(self, field):
+        """
+        One field as a DataFrame, dates down and symbols across.
+        """
+        return pd.DataFrame(self.fields[field], index=pd.DatetimeIndex(self.dates, name='Date'), columns=self.symbols)
 
-    return df
+def make_panel(symbols, days, codes, values):
+    """
+    Panel of rows given as day numbers, positions in symbols and {field: values}.
+    """
+    dates = np.unique(days)
+    rows = np.searchsorted(dates, days)
+    fields = {}
+    for field, v in values.items():
+        a = np.full((len(dates), len(symbols)), np.nan)
+        a[rows, codes] = v
+        fields[field] = a
+    return Panel(dates.astype('datetime64[D]'), symbols, fields)
+
+def query_nse_panel(symbols, fields=PANEL_FIELDS, start_date=None, end_date=None):
+    """
+    Panel of symbols from NSECACHE between start_date and end_date (both optional, included).
+    """
+    symbols = list(dict.fromkeys(symbols))
+    names = ", ".join('"{}"'.format(c) for c in ["Symbol", "Date"] + fields)
+
+    start_day = date_to_day(start_date) if start_date is not None else -2 ** 31
+    end_day = date_to_day(end_date) if end_date is not None else 2 ** 31
+
+    query = 'SELECT {} FROM "NSECACHE" WHERE "Symbol" IN (SELECT "Symbol" FROM temp."PANEL_SYMBOLS") AND "Date" BETWEEN ? AND ?'.format(names)
+
+    db_instance = NSEDB()
+    with stats.stage('sql_read'), db_instance.read() as conn:
+        # Temp tables belong to the connection, and can be written on a read-only one.
+        with conn:
+            conn.execute('CREATE TEMP TABLE IF NOT EXISTS "PANEL_SYMBOLS" ("Symbol" TEXT PRIMARY KEY)')
+            conn.execute('DELETE FROM temp."PANEL_SYMBOLS"')
+            conn.executemany('INSERT INTO temp."PANEL_SYMBOLS" VALUES (?)', [(s,) for s in symbols])
+        df = pd.read_sql_query(query, conn, params=(start_day, end_day))
+    stats.count('rows_read', len(df))
+
+    with stats.stage('to_panel'):
+        codes = pd.Categorical(df["Symbol"], categories=symbols).codes
+        return make_panel(symbols, df["Date"].to_numpy(dtype='int64'), codes,
+                {field: df[field].to_numpy(dtype='float64') for field in fields})
+
+def stack_panel(store, symbols, fields, start_date, end_date):
+    """
+    Panel out of one read_symbol() per symbol, for stores without a panel query.
+    """
+    symbols = list(dict.fromkeys(symbols))
+    days = [np.zeros(0, dtype='int64')]
+    codes = [np.zeros(0, dtype='int64')]
+    values = {field: [np.zeros(0)] for field in fields}
+    for i, symbol in enumerate(symbols):
+        df = slice_by_date(store.read_symbol(symbol, fields), start_date, end_date)
+        days.append(df.index.to_numpy().astype('datetime64[D]').astype('int64'))
+        codes.append(np.full(len(df), i))
+        for field in fields:
+            values[field].append(df[field].to_numpy(dtype='float64'))
+
+    return make_panel(symbols, np.concatenate(days), np.concatenate(codes),
+            {field: np.concatenate(v) for field, v in values.items()})
+
+@stats.timed('get_nse_panel')
+def get_nse_panel(symbols, start, end, fields=PANEL_FIELDS):
+    """
+    Panel of symbols from start to end (dd-mm-yyyy), see Panel. Like get_nse_history(),
+    what the cache is missing is downloaded first (all symbols at once, see prefetch()),
+    unless the cache is open read-only.
+    """
+    start_date = dt.strptime(start, '%d-%m-%Y').date()
+    end_date = dt.strptime(end, '%d-%m-%Y').date()
+
+    if not NSEDB.read_only:
+        prefetch([(symbol, start, end) for symbol in dict.fromkeys(symbols)])
+
+    return store.read_panel(list(symbols), fields, start_date, end_date)
 
 
 """
 NSE Cache implementation END
 """
 
+results_db = "../data/backtest_results.db"
+results = ResultsStore(results_db)
+
+def append_result(row):
+    # Buffered, call results.flush() when done.
+    results.add(row)
+
 def download_data(symbol, date):
     logging.info("Downloading 1 year data for {} from {}".format(symbol, date))
     start_date = dt.strptime(date, '%d-%m-%Y').date()
@@ -305,9 +1026,7 @@ def download_data(symbol, date):
         data_df = get_history(symbol=symbol, start=start_date, end=end_date)
     except Exception as e:
         logging.error("Failed to download data for symbol {}: {}".format(symbol, str(e)))
-        file_loc_err = '../data/.' + symbol + '.err'
-        Path(file_loc_err).touch()
-        sys.exit(0)
+        raise BacktestError("Failed to download data for symbol {}".format(symbol)) from e
 
     # data_df.reset_index(drop=True)
     file_name = '../data/' +  symbol + '.csv'
@@ -315,12 +1034,31 @@ def download_data(symbol, date):
     data_df.to_csv(file_name, header=True)
 
 
-def backtest_sell(symbol, date, price):
-    # get 7 months of data for backtesting..
+# Target and stoploss prices as multiples of the entry price.
+BUY_THRESHOLDS = {'target_15': 1.03, 'target_20': 1.05, 'stoploss': .95}
+SELL_THRESHOLDS = {'target_15': .97, 'target_20': .95, 'stoploss': 1.05}
+
+def backtest_end_date(date):
+    # We backtest 7 months (30 weeks) from the entry date.
     start_date = dt.strptime(date, '%d-%m-%Y').date()
     end_date = start_date + timedelta(weeks=30)
+    return end_date.strftime('%d-%m-%Y')
+
+def get_backtest_window(symbol, date, history=None):
+    """
+    Price data for backtesting a signal of symbol on date.
+    history is an optional SymbolHistory of this symbol that covers the window.
+    """
+    if history is not None:
+        return history.window(date, backtest_end_date(date))
 
-    df = get_nse_history(symbol, date, end_date.strftime('%d-%m-%Y'))
+    return get_nse_history(symbol, date, backtest_end_date(date))
+
+@stats.timed('backtest_sell')
+def backtest_sell(symbol, date, price, write=True, history=None):
+    # get 7 months of data for backtesting..
+    with stats.stage('window'):
+        df = get_backtest_window(symbol, date, history)
 
     # df.set_index('Date', inplace=True)
     # df.index = pd.to_datetime(df.index)
@@ -329,72 +1067,34 @@ def backtest_sell(symbol, date, price):
         try:
             price = df.iloc[0].Close
         except Exception as e:
-            # Something wrong with this symbol.
+            # Something wrong with this symbol on this date.
             logging.error("Stopping backtesting for symbol: {}: {}".format(symbol, str(e)))
-            file_loc_err = '../data/.' + symbol + '.err'
-            Path(file_loc_err).touch()
-            sys.exit(0)
+            raise BacktestError("No price data for symbol {} on {}".format(symbol, date)) from e
 
 
     logging.info("Starting backtesting for Symbol -> %s Price -> %f Date -> %s" % (symbol, price, date))
 
     """
-    Target = 15% of buy price
-    Stoploss = 10% of buy price
+    Targets = 3% and 5% of the price (still named _15/_20, after the 15%/20% targets they replaced)
+    Stoploss = 5% of the price
+    To compare other values, see backtest_sweep.py.
     """
-    target_15 = price * .97
-    target_20 = price * .95
-    stoploss = price * 1.05
-
-    # Variable to be computed
-    max_correction = price
-    result_15 = None # "Target Hit" or "SL Hit"
-    result_20 = None # "Target Hit" or "SL Hit"
-    time_taken = -1
-    time_taken_15 = 0 
-    time_taken_20 = 0 
-
-    target_hit_15 = False
-    target_hit_20 = False
-    sl_hit = False
-
-    low_in_3_months = price
-    low_in_6_months = price
-    # Lets iterate through the rows of the dataframe
-    for index, row in df.iterrows():
-        low = row['Low']
-        high = row['High']
-        close = row['Close']
-
-        time_taken += 1
-        if time_taken == 0:
-            continue
-
-        if target_hit_15 is False and close > stoploss:
-            sl_hit = True
-            result_15 = "SL hit"
-            result_20 = "SL hit"
-            
-        if sl_hit is False and target_hit_15 is False:
-            if low < target_15:
-                result_15 = "Target Hit"
-                target_hit_15 = True
-                time_taken_15 = time_taken
-
-        if sl_hit is False and target_hit_20 is False:
-            if low < target_20:
-                result_20 = "Target Hit"
-                target_hit_20 = True
-                time_taken_20 = time_taken
-
-        if high > max_correction:
-            max_correction = high
-
-        if low < low_in_6_months:
-            low_in_6_months = low
-
-        if time_taken < 90 and low < low_in_3_months:
-            low_in_3_months = low
+    target_15 = price * SELL_THRESHOLDS['target_15']
+    target_20 = price * SELL_THRESHOLDS['target_20']
+    stoploss = price * SELL_THRESHOLDS['stoploss']
+
+    with stats.stage('evaluate'):
+        out = evaluate_sell(*price_arrays(df), price, target_15, target_20, stoploss)
+    target_hit_15 = out['target_hit_15']
+    target_hit_20 = out['target_hit_20']
+    sl_hit = out['sl_hit']
+    result_15 = out['result_15'] # "Target Hit" or "SL Hit"
+    result_20 = out['result_20'] # "Target Hit" or "SL Hit"
+    time_taken_15 = out['time_taken_15']
+    time_taken_20 = out['time_taken_20']
+    max_correction = out['max_correction']
+    low_in_3_months = out['low_in_3_months']
+    low_in_6_months = out['low_in_6_months']
 
     if max_correction != 99999:
         max_correction_p = ((price - max_correction)/price) * 100
@@ -412,20 +1112,35 @@ def backtest_sell(symbol, date, price):
     time_taken_20:       {}
     """.format(target_hit_15, target_hit_20, sl_hit, max_correction_p, low_in_3_months, low_in_6_months, time_taken_15, time_taken_20))
 
-    # Update backtest results csv file.
-    """
-    Date,Symbol,Marketcapname,Sector,Buy Price,Stoploss(10%),Target(15%),Max correction from Buy Price,Result(15% Target),Time taken to hit 15%,Target(20%),Time taken to hit 20%,Result(20% Target),High in 3 Months,High in 6 Months
-    """
-    with open("../data/backtest_results.csv", "a") as fh:
-        entry_str = "{},{},---, ---,{},{},{},{},{},{},{},{},{},{},{}\n".format(date, symbol, price, stoploss, target_15, max_correction_p, result_15, time_taken_15, target_20, time_taken_20, result_20, low_in_3_months, low_in_6_months)
-        fh.write(entry_str)
-
-def backtest_buy(symbol, date, price):
+    # Update backtest results.
+    row = {
+        "Symbol": symbol,
+        "Date": dt.strptime(date, '%d-%m-%Y').date(),
+        "Side": "sell",
+        "Params": params_key(SELL_THRESHOLDS),
+        "Price": price,
+        "Stoploss": stoploss,
+        "Target 15": target_15,
+        "Max Correction %": max_correction_p,
+        "Result 15": result_15,
+        "Time Taken 15": time_taken_15,
+        "Target 20": target_20,
+        "Time Taken 20": time_taken_20,
+        "Result 20": result_20,
+        "Best 3 Months": low_in_3_months,
+        "Best 6 Months": low_in_6_months,
+    }
+    if write:
+        with stats.stage('result_write'):
+            append_result(row)
+
+    return row
+
+@stats.timed('backtest_buy')
+def backtest_buy(symbol, date, price, write=True, history=None):
     # get 7 months of data for backtesting..
-    start_date = dt.strptime(date, '%d-%m-%Y').date()
-    end_date = start_date + timedelta(weeks=30)
-
-    df = get_nse_history(symbol, date, end_date.strftime('%d-%m-%Y'))
+    with stats.stage('window'):
+        df = get_backtest_window(symbol, date, history)
 
     # df.set_index('Date', inplace=True)
     # df.index = pd.to_datetime(df.index)
@@ -434,72 +1149,34 @@ def backtest_buy(symbol, date, price):
         try:
             price = df.iloc[0].Close
         except Exception as e:
-            # Something wrong with this symbol.
+            # Something wrong with this symbol on this date.
             logging.error("Stopping backtesting for symbol: {}: {}".format(symbol, str(e)))
-            file_loc_err = '../data/.' + symbol + '.err'
-            Path(file_loc_err).touch()
-            sys.exit(0)
+            raise BacktestError("No price data for symbol {} on {}".format(symbol, date)) from e
 
 
     logging.info("Starting backtesting for Symbol -> %s Price -> %f Date -> %s" % (symbol, price, date))
 
     """
-    Target = 15% of buy price
-    Stoploss = 10% of buy price
+    Targets = 3% and 5% of the price (still named _15/_20, after the 15%/20% targets they replaced)
+    Stoploss = 5% of the price
+    To compare other values, see backtest_sweep.py.
     """
-    target_15 = price * 1.03
-    target_20 = price * 1.05
-    stoploss = price * .95
-
-    # Variable to be computed
-    max_correction = price
-    result_15 = None # "Target Hit" or "SL Hit"
-    result_20 = None # "Target Hit" or "SL Hit"
-    time_taken = -1
-    time_taken_15 = 0 
-    time_taken_20 = 0 
-
-    target_hit_15 = False
-    target_hit_20 = False
-    sl_hit = False
-
-    high_in_3_months = 0
-    high_in_6_months = 0
-    # Lets iterate through the rows of the dataframe
-    for index, row in df.iterrows():
-        low = row['Low']
-        high = row['High']
-        close = row['Close']
-
-        time_taken += 1
-        if time_taken == 0:
-            continue
-
-        if target_hit_15 is False and close < stoploss:
-            sl_hit = True
-            result_15 = "SL hit"
-            result_20 = "SL hit"
-            
-        if sl_hit is False and target_hit_15 is False:
-            if high > target_15:
-                result_15 = "Target Hit"
-                target_hit_15 = True
-                time_taken_15 = time_taken
-
-        if sl_hit is False and target_hit_20 is False:
-            if high > target_20:
-                result_20 = "Target Hit"
-                target_hit_20 = True
-                time_taken_20 = time_taken
-
-        if low < max_correction and target_hit_15 is False:
-            max_correction = low
-
-        if high > high_in_6_months:
-            high_in_6_months = high
-
-        if time_taken < 90 and high > high_in_3_months:
-            high_in_3_months = high
+    target_15 = price * BUY_THRESHOLDS['target_15']
+    target_20 = price * BUY_THRESHOLDS['target_20']
+    stoploss = price * BUY_THRESHOLDS['stoploss']
+
+    with stats.stage('evaluate'):
+        out = evaluate_buy(*price_arrays(df), price, target_15, target_20, stoploss)
+    target_hit_15 = out['target_hit_15']
+    target_hit_20 = out['target_hit_20']
+    sl_hit = out['sl_hit']
+    result_15 = out['result_15'] # "Target Hit" or "SL Hit"
+    result_20 = out['result_20'] # "Target Hit" or "SL Hit"
+    time_taken_15 = out['time_taken_15']
+    time_taken_20 = out['time_taken_20']
+    max_correction = out['max_correction']
+    high_in_3_months = out['high_in_3_months']
+    high_in_6_months = out['high_in_6_months']
 
     if max_correction != 99999:
         max_correction_p = ((price - max_correction)/price) * 100
@@ -517,15 +1194,31 @@ def backtest_buy(symbol, date, price):
     time_taken_20:       {}
     """.format(target_hit_15, target_hit_20, sl_hit, max_correction_p, high_in_3_months, high_in_6_months, time_taken_15, time_taken_20))
 
-    # Update backtest results csv file.
-    """
-    Date,Symbol,Marketcapname,Sector,Buy Price,Stoploss(10%),Target(15%),Max correction from Buy Price,Result(15% Target),Time taken to hit 15%,Target(20%),Time taken to hit 20%,Result(20% Target),High in 3 Months,High in 6 Months
-    """
-    with open("../data/backtest_results.csv", "a") as fh:
-        entry_str = "{},{},---, ---,{},{},{},{},{},{},{},{},{},{},{}\n".format(date, symbol, price, stoploss, target_15, max_correction_p, result_15, time_taken_15, target_20, time_taken_20, result_20, high_in_3_months, high_in_6_months)
-        fh.write(entry_str)
-
-def main():
+    # Update backtest results.
+    row = {
+        "Symbol": symbol,
+        "Date": dt.strptime(date, '%d-%m-%Y').date(),
+        "Side": "buy",
+        "Params": params_key(BUY_THRESHOLDS),
+        "Price": price,
+        "Stoploss": stoploss,
+        "Target 15": target_15,
+        "Max Correction %": max_correction_p,
+        "Result 15": result_15,
+        "Time Taken 15": time_taken_15,
+        "Target 20": target_20,
+        "Time Taken 20": time_taken_20,
+        "Result 20": result_20,
+        "Best 3 Months": high_in_3_months,
+        "Best 6 Months": high_in_6_months,
+    }
+    if write:
+        with stats.stage('result_write'):
+            append_result(row)
+
+    return row
+
+def setup_logging():
     # Setup logging
     stream_handler = logging.StreamHandler()
     stream_handler.setLevel(logging.DEBUG)
@@ -535,6 +1228,31 @@ def main():
             format=log_format,
             handlers=[logging.FileHandler("backtest_log.txt", mode="a"), stream_handler])
 
+def side_params(type):
+    """
+    Params of the results and runs of type (see backtest_results.params_key()).
+    """
+    if type == 'buy':
+        return params_key(BUY_THRESHOLDS)
+    return params_key(SELL_THRESHOLDS)
+
+def run_backtest(symbol, date, price, type, write=True, history=None):
+    """
+    Backtest one signal and return its results row (see backtest_results).
+    With write=False the caller is responsible for adding the row to results.
+    history is an optional SymbolHistory, see get_backtest_window().
+    Raises BacktestError if this signal could not be backtested.
+    """
+    if type == 'buy':
+        return backtest_buy(symbol, date, price, write, history)
+    elif type == 'sell':
+        return backtest_sell(symbol, date, price, write, history)
+    else:
+        print("--type should be buy or sell.")
+
+def main():
+    setup_logging()
+
     parser = argparse.ArgumentParser(
             description="""
             ==============================
@@ -548,38 +1266,44 @@ def main():
     parser.add_argument('--price', metavar='price', help='buy price (0 for close price of the day)', type=float)
     parser.add_argument('--type', metavar='type', help='long or short', type=str)
     parser.add_argument('--update_db', help='Update the nsecache DB (time taking!!)', action='store_true', default=False)
+    parser.add_argument('--migrate_db', help='Migrate the nsecache DB to the current schema', action='store_true', default=False)
+    parser.add_argument('--store', metavar='store', help='price history store: sqlite, parquet, feather or mmap', type=str, default='sqlite')
+    parser.add_argument('--rerun', help='backtest again even if this signal is done', action='store_true', default=False)
 
     args = parser.parse_args()
 
+    if args.migrate_db:
+        migrate_db()
+        sys.exit(0)
+
+    use_store(args.store)
+
     if args.update_db:
         print("Update the NSE cache DB..")
+        update_db()
         sys.exit(0)
+
     # print(vars(args))
     print(args.symbol, args.date, args.price)
     logging.info("Starting backtesting for symbol {} date {} buy price {}".format(args.symbol, args.date, args.price))
 
-    """
-    Check if we have already backtested this symbol. If .symbol.done or.symbol.err file exists, we don't backtest this symbol.
-    """
-    file_loc_check = '../data/.' + args.symbol + '.done'
-    file_loc_err = '../data/.' + args.symbol + '.err'
-
-    my_file = Path(file_loc_check)
-    if my_file.is_file():
-        logging.info("{} file found. Skipping backtesting. If you want to backtest it again, delete this file.".format(file_loc_check)) 
+    if args.type not in ('buy', 'sell'):
+        print("--type should be buy or sell.")
         sys.exit(0)
 
-    my_file = Path(file_loc_err)
-    if my_file.is_file():
-        logging.info("{} file found. Skipping backtesting. If you want to backtest it again, delete this file. Check the symbol properly, last time while backtesting this symbol, and error was encountered.".format(file_loc_err)) 
+    entry_date = dt.strptime(args.date, '%d-%m-%Y').date()
+    params = side_params(args.type)
+    if not args.rerun and results.status(args.symbol, entry_date, args.type, params) == RUN_DONE:
+        logging.info("{} {} {} is already backtested. Use --rerun to backtest it again.".format(args.symbol, args.date, args.type))
         sys.exit(0)
 
-    if args.type == 'buy':
-        backtest_buy(args.symbol, args.date, args.price)
-    elif args.type == 'sell':
-        backtest_sell(args.symbol, args.date, args.price)
-    else:
-        print("--type should be buy or sell.")
+    try:
+        run_backtest(args.symbol, args.date, args.price, args.type)
+    except BacktestError as e:
+        results.add_failure(args.symbol, entry_date, args.type, params, str(e))
+        sys.exit(0)
+    finally:
+        results.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,256 @@
+#!/home/mansuman/venv/bin/python
+import io
+import sys
+import json
+import time
+import zlib
+import shutil
+import argparse
+import logging
+import platform
+import contextlib
+from pathlib import Path
+from datetime import date
+from datetime import datetime as dt
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+
+import backtest
+import nse_calendar
+import process_backtest_data_file as batch
+from backtest import NSEDB
+from backtest_results import ResultsStore
+
+
+"""
+Benchmarks.
+Runs offline: a synthetic NSECACHE of --symbols x --years is generated in
+.nsecache_bench/ (the real cache is not touched) and get_history is replaced by
+synthetic_history(), which makes up the same prices for a symbol every time.
+Timed are the cache write, get_nse_history_from_cache, get_nse_history (with an
+empty and with a warm price cache), get_nse_panel of all symbols,
+backtest_buy/backtest_sell and a whole batch file, each reported as throughput
+and latency percentiles.
+Save a run as the baseline, and compare later runs with it:
+    ./backtest_benchmark.py --symbols 100 --years 5 --save ../data/benchmark.json
+    ./backtest_benchmark.py --symbols 100 --years 5 --compare ../data/benchmark.json
+"""
+bench_dir = "./.nsecache_bench/"
+
+# Synthetic prices start here, so that any range of a symbol reads the same prices.
+SYNTHETIC_START = date(2005, 1, 3)
+
+def synthetic_history(symbol, start, end):
+    """
+    A get_history() stand-in: a random walk per symbol on the trading days of nse_calendar.
+    """
+    calendar = nse_calendar.get_calendar()
+    sessions = calendar.sessions[(calendar.sessions >= nse_calendar.day_number(SYNTHETIC_START)) &
+            (calendar.sessions <= nse_calendar.day_number(end))]
+
+    # Closes and spreads from their own generators, so that the first n of each are the same whatever end is.
+    seed = zlib.crc32(symbol.encode())
+    close = 100 * np.exp(np.cumsum(np.random.default_rng(seed).normal(0, 0.02, len(sessions))))
+    spread = np.abs(np.random.default_rng(seed + 1).normal(0, 0.01, len(sessions)))
+    rng = np.random.default_rng(seed + 2)
+
+    keep = sessions >= nse_calendar.day_number(start)
+    sessions, close, spread = sessions[keep], close[keep], spread[keep]
+    volume = rng.integers(1000, 1000000, len(sessions))
+
+    index = pd.Index([nse_calendar.from_day_number(n) for n in sessions], name='Date')
+    return pd.DataFrame({
+        'Symbol': symbol, 'Series': 'EQ', 'Prev Close': np.concatenate((close[:1], close[:-1])),
+        'Open': close * (1 - spread / 2), 'High': close * (1 + spread), 'Low': close * (1 - spread),
+        'Last': close, 'Close': close, 'VWAP': close, 'Volume': volume, 'Turnover': close * volume,
+        'Trades': volume // 100, 'Deliverable Volume': volume // 2, '%Deliverble': 0.5}, index=index)
+
+def use_bench_cache(directory=bench_dir):
+    """
+    Point the cache, the results and get_history at the benchmark.
+    """
+    NSEDB.reset()
+    NSEDB.working_dir = directory
+    NSEDB.db_location = directory + NSEDB.db_name
+    backtest.results = ResultsStore(directory + "backtest_results.db")
+    batch.stats_file = directory + "backtest_stats.json"
+    backtest.get_history = synthetic_history
+    backtest.price_cache.clear()
+
+def generate_db(symbols, years, directory=bench_dir):
+    """
+    A fresh synthetic cache of symbols symbols with years of history up to the last session.
+    Returns the symbol names, the first and the last date, and the write timing.
+    """
+    shutil.rmtree(directory, ignore_errors=True)
+    use_bench_cache(directory)
+
+    calendar = nse_calendar.get_calendar()
+    end = calendar.previous_session(date.today() - timedelta(days=1))
+    start = calendar.next_session(end - timedelta(days=365 * years))
+    names = ["SYM{:05d}".format(i) for i in range(symbols)]
+
+    rows = 0
+    started = time.perf_counter()
+    for i in range(0, len(names), 50):
+        rows += backtest.write_nse_history(pd.concat([synthetic_history(name, start, end) for name in names[i:i + 50]]))
+    for name in names:
+        backtest.record_coverage(name, start, end)
+    elapsed = time.perf_counter() - started
+
+    return names, start, end, {'count': rows, 'seconds': elapsed, 'per_s': rows / elapsed}
+
+def summarize(samples):
+    """
+    Throughput and latency percentiles (ms) of a list of timings in seconds.
+    """
+    ms = np.asarray(samples) * 1000
+    return {
+        'count': len(ms),
+        'seconds': float(ms.sum() / 1000),
+        'per_s': float(len(ms) / (ms.sum() / 1000)) if ms.sum() > 0 else 0.0,
+        'mean_ms': float(ms.mean()),
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p90_ms': float(np.percentile(ms, 90)),
+        'p99_ms': float(np.percentile(ms, 99)),
+        'max_ms': float(ms.max()),
+    }
+
+def timed(fn, calls, before=None):
+    """
+    Seconds taken by fn(*args) for every args of calls. before() runs first, untimed.
+    """
+    samples = []
+    for args in calls:
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        fn(*args)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+def signals(names, start, end, count, rng):
+    """
+    count (symbol, entry date) whose whole backtest window is in [start, end].
+    """
+    calendar = nse_calendar.get_calendar()
+    last_entry = calendar.previous_session(end - timedelta(weeks=30))
+    first = nse_calendar.day_number(start)
+    span = nse_calendar.day_number(last_entry) - first
+    out = []
+    for i in range(count):
+        entry = calendar.next_session(nse_calendar.from_day_number(first + int(rng.integers(0, span))))
+        out.append((names[int(rng.integers(0, len(names)))], entry.strftime('%d-%m-%Y')))
+    return out
+
+def run(symbols, years, samples, batch_signals, workers, store):
+    rng = np.random.default_rng(0)
+    report = {}
+
+    names, start, end, report['cache_write'] = generate_db(symbols, years)
+    if store == 'mmap':
+        import nsecache_mmap
+        nsecache_mmap.compile_store()
+    elif store in ('parquet', 'feather'):
+        import nsecache_parquet
+        backtest.use_store(store)
+        nsecache_parquet.migrate(backtest.store)
+    backtest.use_store(store)
+
+    calls = signals(names, start, end, samples, rng)
+    windows = [(symbol, date, backtest.backtest_end_date(date)) for symbol, date in calls]
+
+    report['get_nse_history_from_cache'] = summarize(timed(backtest.get_nse_history_from_cache, windows))
+    report['get_nse_history_cold'] = summarize(timed(backtest.get_nse_history, windows, before=backtest.price_cache.clear))
+    # Every symbol is in the price cache from here on.
+    timed(backtest.get_nse_history, windows)
+    report['get_nse_history_warm'] = summarize(timed(backtest.get_nse_history, windows))
+    # Every symbol over the window of a signal, in one query
+    report['get_nse_panel'] = summarize(timed(backtest.get_nse_panel, [(names, date, end) for symbol, date, end in windows[:20]]))
+    for type, fn in (('buy', backtest.backtest_buy), ('sell', backtest.backtest_sell)):
+        report['backtest_' + type] = summarize(timed(fn, [(symbol, date, 0, False) for symbol, date in calls]))
+
+    # End to end: a signal file through process_backtest_data_file, in a fresh results store.
+    signal_file = bench_dir + "signals.csv"
+    pd.DataFrame(signals(names, start, end, batch_signals, rng), columns=['symbol', 'date']).to_csv(signal_file, index=False)
+    backtest.results = ResultsStore(bench_dir + "batch_results.db")
+    backtest.price_cache.clear()
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        batch.run_batch(signal_file, 'buy', workers)
+    elapsed = time.perf_counter() - started
+    report['batch'] = {'count': batch_signals, 'seconds': elapsed, 'per_s': batch_signals / elapsed}
+
+    return {
+        'created': dt.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'config': {'symbols': symbols, 'years': years, 'samples': samples, 'signals': batch_signals, 'workers': workers, 'store': store},
+        'results': report,
+    }
+
+def print_report(report, baseline=None, tolerance=0.1):
+    """
+    One line per benchmark. With a baseline, the change in throughput is shown and
+    slowdowns of more than tolerance are marked. Returns the number of those.
+    """
+    regressions = 0
+    for name, r in report['results'].items():
+        line = "{:28} {:8} x {:10.1f}/s".format(name, r['count'], r['per_s'])
+        if 'p50_ms' in r:
+            line += "   p50 {:8.3f} ms  p90 {:8.3f} ms  p99 {:8.3f} ms".format(r['p50_ms'], r['p90_ms'], r['p99_ms'])
+        if baseline is not None and name in baseline['results']:
+            change = r['per_s'] / baseline['results'][name]['per_s'] - 1
+            line += "   {:+.1%}".format(change)
+            if change < -tolerance:
+                line += " REGRESSION"
+                regressions += 1
+        print(line)
+    return regressions
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+
+    parser = argparse.ArgumentParser(
+            description="""
+            ==============================
+            Offline benchmarks of the cache and the backtest
+            ==============================
+            """
+            )
+
+    parser.add_argument('--symbols', metavar='symbols', help='symbols in the synthetic cache', type=int, default=50)
+    parser.add_argument('--years', metavar='years', help='years of history per symbol', type=int, default=5)
+    parser.add_argument('--samples', metavar='samples', help='calls per timed function', type=int, default=300)
+    parser.add_argument('--signals', metavar='signals', help='rows in the batch file', type=int, default=1000)
+    parser.add_argument('--workers', metavar='workers', help='batch worker processes', type=int, default=1)
+    parser.add_argument('--store', metavar='store', help='price history store: sqlite, parquet, feather or mmap', type=str, default='sqlite')
+    parser.add_argument('--save', metavar='path', help='write the results as json', type=str)
+    parser.add_argument('--compare', metavar='path', help='compare with the results of an earlier --save', type=str)
+    parser.add_argument('--tolerance', metavar='tolerance', help='slowdown reported as a regression (default 0.1)', type=float, default=0.1)
+
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)
+        if baseline['config'] != {'symbols': args.symbols, 'years': args.years, 'samples': args.samples,
+                'signals': args.signals, 'workers': args.workers, 'store': args.store}:
+            print("Warning: baseline config {} differs from this run".format(baseline['config']))
+
+    report = run(args.symbols, args.years, args.samples, args.signals, args.workers, args.store)
+    regressions = print_report(report, baseline, args.tolerance)
+
+    if args.save:
+        Path(args.save).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.save, "w") as fh:
+            json.dump(report, fh, indent=2)
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+#!/home/mansuman/venv/bin/python
+import sys
+import json
+import socket
+import argparse
+
+
+"""
+Client of the backtest daemon (./backtest_server.py).
+Takes the same flags as ./backtest.py, but the backtest runs in the daemon,
+which has pandas imported, the cache open and the price history parsed already:
+    ./backtest_client.py --symbol INFY --date 01-02-2021 --price 0 --type buy
+Only the standard library is imported here, so starting the client is cheap.
+From python (a notebook), keep one connection for many jobs:
+    with Client() as client:
+        reply = client.backtest('INFY', '01-02-2021', 0, 'buy')
+The protocol is one json object per line each way. A request has an "op"
+(backtest, update_db, migrate_db, stats, ping or shutdown) and its fields; a
+reply has "ok", and "error" when ok is false. A backtest reply has the "status"
+of the run (done, failed or skipped when it was done before) and its results
+"row", with the Date as dd-mm-yyyy.
+"""
+SOCKET_PATH = "./.nsecache/backtest.sock"
+
+def encode(message):
+    return (json.dumps(message) + "\n").encode()
+
+class DaemonError(Exception):
+    """
+    Raised when the daemon can not be reached or hangs up.
+    """
+    pass
+
+class Client:
+    def __init__(self, path=SOCKET_PATH, timeout=None):
+        self.path = path
+        self.timeout = timeout
+        self.sock = None
+        self.rfile = None
+
+    def connect(self):
+        if self.sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.path)
+            except OSError as e:
+                sock.close()
+                raise DaemonError("Could not connect to the backtest daemon at {}: {}. Start it with ./backtest_server.py".format(self.path, str(e))) from e
+            self.sock = sock
+            self.rfile = sock.makefile("rb")
+
+    def close(self):
+        if self.sock is not None:
+            self.rfile.close()
+            self.sock.close()
+            self.sock = None
+            self.rfile = None
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def request(self, op, **fields):
+        """
+        Send one request and wait for its reply.
+        """
+        self.connect()
+        try:
+            self.sock.sendall(encode(dict(fields, op=op)))
+            line = self.rfile.readline()
+        except OSError as e:
+            self.close()
+            raise DaemonError("Lost the connection to the backtest daemon: {}".format(str(e))) from e
+        if not line:
+            self.close()
+            raise DaemonError("The backtest daemon closed the connection")
+        return json.loads(line)
+
+    def backtest(self, symbol, date, price=0, type='buy', rerun=False, store=None):
+        return self.request('backtest', symbol=symbol, date=date, price=price, type=type, rerun=rerun, store=store)
+
+def print_reply(reply):
+    if not reply['ok']:
+        print("Error: {}".format(reply['error']))
+        return
+
+    if 'status' in reply:
+        print("Status: {}{}".format(reply['status'], " (use --rerun to backtest it again)" if reply['status'] == 'skipped' else ""))
+    if reply.get('row'):
+        for name, value in reply['row'].items():
+            print("{:18} {}".format(name, value))
+    for name in ('stages', 'counters', 'price_cache'):
+        if name in reply:
+            print("{}: {}".format(name, json.dumps(reply[name], indent=2)))
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="""
+            ==============================
+            Backtest, in the backtest daemon
+            ==============================
+            """
+            )
+
+    parser.add_argument('--symbol', metavar='symbol', help='symbol to backtest', type=str)
+    parser.add_argument('--date', metavar='date', help='date of entry if dd-mm-yyyy format', type=str)
+    parser.add_argument('--price', metavar='price', help='buy price (0 for close price of the day)', type=float)
+    parser.add_argument('--type', metavar='type', help='long or short', type=str)
+    parser.add_argument('--update_db', help='Update the nsecache DB (time taking!!)', action='store_true', default=False)
+    parser.add_argument('--migrate_db', help='Migrate the nsecache DB to the current schema', action='store_true', default=False)
+    parser.add_argument('--store', metavar='store', help='price history store: sqlite, parquet, feather or mmap (default: the daemon\'s)', type=str)
+    parser.add_argument('--rerun', help='backtest again even if this signal is done', action='store_true', default=False)
+    parser.add_argument('--socket', metavar='socket', help='socket of the daemon (default {})'.format(SOCKET_PATH), type=str, default=SOCKET_PATH)
+    parser.add_argument('--stats', help='show the stage timings and cache stats of the daemon', action='store_true', default=False)
+    parser.add_argument('--shutdown', help='stop the daemon', action='store_true', default=False)
+
+    args = parser.parse_args()
+
+    if args.migrate_db:
+        request = {'op': 'migrate_db'}
+    elif args.update_db:
+        request = {'op': 'update_db', 'store': args.store}
+    elif args.stats:
+        request = {'op': 'stats'}
+    elif args.shutdown:
+        request = {'op': 'shutdown'}
+    else:
+        if args.type not in ('buy', 'sell'):
+            print("--type should be buy or sell.")
+            sys.exit(0)
+        print(args.symbol, args.date, args.price)
+        request = {'op': 'backtest', 'symbol': args.symbol, 'date': args.date, 'price': args.price,
+                'type': args.type, 'rerun': args.rerun, 'store': args.store}
+
+    try:
+        with Client(args.socket) as client:
+            reply = client.request(**request)
+    except DaemonError as e:
+        print(str(e))
+        sys.exit(1)
+
+    print_reply(reply)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import numpy as np
+
+
+"""
+Vectorized backtest evaluation.
+These functions give exactly the same answers as walking the price window bar by
+bar (the old iterrows() loop in backtest_buy/backtest_sell), but work on whole
+NumPy arrays of High/Low/Close at once.
+Day 0 is the entry day and is never looked at. NaN prices never hit anything.
+"""
+# Bars 1..89 make up the "3 months" window.
+BARS_3_MONTHS = 90
+
+def first_hit(mask):
+    """
+    Index of the first True in mask, skipping day 0.
+    Returns len(mask) if there is none.
+    """
+    hits = np.flatnonzero(mask[1:])
+    if hits.size == 0:
+        return len(mask)
+    return int(hits[0]) + 1
+
+def running_max(values, initial):
+    # max(initial, values) ignoring NaN. Keeps initial (and its type) if nothing beats it.
+    values = values[values > initial]
+    if values.size == 0:
+        return initial
+    return values.max()
+
+def running_min(values, initial):
+    values = values[values < initial]
+    if values.size == 0:
+        return initial
+    return values.min()
+
+def resolve_targets(sl_mask, target_15_mask, target_20_mask):
+    """
+    Work out which of stoploss / 15% target / 20% target was hit, and when.
+    The stoploss only counts until the 15% target is hit, and on the same day the
+    stoploss is checked before the targets. Once the stoploss is hit no target can
+    be hit any more, and both results read "SL hit".
+    """
+    n = len(sl_mask)
+    hit_sl = first_hit(sl_mask)
+    hit_15 = first_hit(target_15_mask)
+    hit_20 = first_hit(target_20_mask)
+
+    sl_hit = hit_sl < n and hit_sl <= hit_15
+    target_hit_15 = hit_15 < n and not sl_hit
+    target_hit_20 = hit_20 < n and (not sl_hit or hit_20 < hit_sl)
+
+    if sl_hit:
+        result_15 = "SL hit"
+        result_20 = "SL hit"
+    else:
+        result_15 = "Target Hit" if target_hit_15 else None
+        result_20 = "Target Hit" if target_hit_20 else None
+
+    return {
+        'target_hit_15': target_hit_15,
+        'target_hit_20': target_hit_20,
+        'sl_hit': sl_hit,
+        'result_15': result_15,
+        'result_20': result_20,
+        'time_taken_15': hit_15 if target_hit_15 else 0,
+        'time_taken_20': hit_20 if target_hit_20 else 0,
+    }
+
+def evaluate_buy(high, low, close, price, target_15, target_20, stoploss):
+    """
+    Long trade: targets are hit on High, stoploss on Close, and the max correction
+    is the lowest Low before the 15% target is hit.
+    Returns a dict with the same variables backtest_buy logs and writes.
+    """
+    out = resolve_targets(close < stoploss, high > target_15, high > target_20)
+
+    end = out['time_taken_15'] if out['target_hit_15'] else len(low)
+    out['max_correction'] = running_min(low[1:end], price)
+    out['high_in_3_months'] = running_max(high[1:BARS_3_MONTHS], 0)
+    out['high_in_6_months'] = running_max(high[1:], 0)
+
+    return out
+
+def evaluate_sell(high, low, close, price, target_15, target_20, stoploss):
+    """
+    Short trade: targets are hit on Low, stoploss on Close, and the max correction
+    is the highest High over the whole window.
+    Returns a dict with the same variables backtest_sell logs and writes.
+    """
+    out = resolve_targets(close > stoploss, low < target_15, low < target_20)
+
+    out['max_correction'] = running_max(high[1:], price)
+    out['low_in_3_months'] = running_min(low[1:BARS_3_MONTHS], price)
+    out['low_in_6_months'] = running_min(low[1:], price)
+
+    return out
+
+def price_arrays(df):
+    """
+    High, Low and Close of a get_nse_history() frame as float64 arrays.
+    """
+    if df.empty:
+        empty = np.empty(0, dtype='float64')
+        return empty, empty, empty
+
+    return (df['High'].to_numpy(dtype='float64'),
+            df['Low'].to_numpy(dtype='float64'),
+            df['Close'].to_numpy(dtype='float64'))
+
+"""
+Parameter sweep.
+Every (target, stoploss) pair of a grid is evaluated against one price window
+at once: the thresholds are broadcast against the bars, so the window is scanned
+once per threshold, not once per pair. A pair gives the same answer as
+evaluate_buy/evaluate_sell would with that pair as the 15% target and stoploss.
+"""
+def first_hits(mask):
+    """
+    first_hit() of every row of a 2-D mask.
+    """
+    n = mask.shape[1]
+    if n <= 1:
+        # Only day 0, or nothing: no hits.
+        return np.full(mask.shape[0], n)
+    rest = mask[:, 1:]
+    hit = rest.any(axis=1)
+    return np.where(hit, rest.argmax(axis=1) + 1, n)
+
+def resolve_grid(sl_mask, target_mask):
+    """
+    resolve_targets() for every (target row, stoploss row) pair of the masks.
+    Returns (targets x stoplosses) arrays: target_hit, sl_hit, time_taken, time_to_sl.
+    """
+    n = sl_mask.shape[1]
+    hit_sl = first_hits(sl_mask)[np.newaxis, :]
+    hit_target = first_hits(target_mask)[:, np.newaxis]
+
+    sl_hit = (hit_sl < n) & (hit_sl <= hit_target)
+    target_hit = (hit_target < n) & ~sl_hit
+
+    return {
+        'target_hit': target_hit,
+        'sl_hit': sl_hit,
+        'time_taken': np.where(target_hit, hit_target, 0),
+        'time_to_sl': np.where(sl_hit, hit_sl, 0),
+    }
+
+def sweep_buy(high, low, close, target_prices, stoploss_prices):
+    # Long trade: targets on High, stoploss on Close.
+    return resolve_grid(close[np.newaxis, :] < stoploss_prices[:, np.newaxis],
+            high[np.newaxis, :] > target_prices[:, np.newaxis])
+
+def sweep_sell(high, low, close, target_prices, stoploss_prices):
+    # Short trade: targets on Low, stoploss on Close.
+    return resolve_grid(close[np.newaxis, :] > stoploss_prices[:, np.newaxis],
+            low[np.newaxis, :] < target_prices[:, np.newaxis])
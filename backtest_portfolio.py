@@ -0,0 +1,310 @@
+#!/home/mansuman/venv/bin/python
+import sys
+import math
+import heapq
+import argparse
+import logging
+import itertools
+from pathlib import Path
+from collections import Counter, defaultdict, deque
+from datetime import datetime as dt
+import numpy as np
+import pandas as pd
+
+import backtest
+import nse_fetch
+import nse_calendar
+import process_backtest_data_file as batch
+from backtest import BacktestError
+
+
+"""
+Portfolio simulator.
+backtest_buy/backtest_sell look at every signal on its own. Here all signals of a
+file share one account: capital, at most max_positions open at a time (and
+per_symbol per symbol), and each new position gets size of the equity. A signal
+that does not fit is rejected.
+The bars of all symbols are merged into one date-ordered stream (a heap over
+the symbols, see bar_stream()) and swept once. On every day the open positions
+are checked for an exit first, then the signals of the day are entered in file
+order, then the account is marked to market. Exits follow backtest_kernel: the
+stoploss is hit on Close and checked before the target, which is hit on High
+(Low for sell) and filled at the target price. A position still open at the end
+of the backtest window (30 weeks, see backtest_end_date()) is closed at its last
+Close. Entries are at the Close of the first bar on or after the signal date,
+like price 0 in backtest.py.
+    ./backtest_portfolio.py --file ../data/backtest_data.csv --type buy --capital 1000000 --max_positions 10 --size 0.1
+writes the equity curve to equity_file and the trades to trades_file.
+"""
+equity_file = "../data/portfolio_equity.csv"
+trades_file = "../data/portfolio_trades.csv"
+
+CAPITAL = 1000000.0
+MAX_POSITIONS = 10
+POSITION_SIZE = 0.1
+
+class Signal:
+    def __init__(self, sequence, symbol, date):
+        self.sequence = sequence
+        self.symbol = symbol
+        self.date = date
+        self.day = nse_calendar.day_number(date)
+        self.end_day = nse_calendar.day_number(dt.strptime(backtest.backtest_end_date(date.strftime('%d-%m-%Y')), '%d-%m-%Y').date())
+
+class Position:
+    def __init__(self, signal, entry_bar, last_bar, price, shares, target, stoploss):
+        self.signal = signal
+        self.entry_bar = entry_bar
+        # Last bar of the backtest window
+        self.last_bar = last_bar
+        self.price = price
+        self.shares = shares
+        self.target = target
+        self.stoploss = stoploss
+
+class History:
+    """
+    Bars of one symbol as arrays: day numbers, High, Low, Close.
+    """
+    def __init__(self, df):
+        self.days = df.index.to_numpy().astype('datetime64[D]').astype('int64')
+        self.high = df['High'].to_numpy(dtype='float64')
+        self.low = df['Low'].to_numpy(dtype='float64')
+        self.close = df['Close'].to_numpy(dtype='float64')
+
+def read_signals(backtest_file):
+    """
+    Signals of the signal file in file order, see process_backtest_data_file.parse_signals().
+    """
+    signals = []
+    totals = Counter()
+    for df in batch.parse_signals(batch.read_signals(backtest_file), totals):
+        for symbol, date in zip(df['symbol'], df['date']):
+            signals.append(Signal(len(signals), symbol, dt.strptime(date, '%d-%m-%Y').date()))
+    return signals
+
+def load_histories(signals, fetch_workers=nse_fetch.FETCH_WORKERS):
+    """
+    {symbol: History} over the span of the backtest windows of its signals, read
+    once per symbol. Missing history is downloaded first for all symbols at once.
+    """
+    dates = defaultdict(list)
+    for signal in signals:
+        dates[signal.symbol].append(signal.date.strftime('%d-%m-%Y'))
+
+    batch.prefetch_tasks([(symbol, symbol_dates, None, False) for symbol, symbol_dates in dates.items()], fetch_workers)
+
+    histories = {}
+    for symbol, symbol_dates in dates.items():
+        try:
+            history = batch.symbol_history(symbol, symbol_dates)
+            history.load()
+        except BacktestError as e:
+            logging.error("No history for {}: {}".format(symbol, str(e)))
+            continue
+        if not history.df.empty:
+            histories[symbol] = History(history.df)
+    return histories
+
+def symbol_bars(symbol, days):
+    for i, day in enumerate(days.tolist()):
+        yield day, symbol, i
+
+def bar_stream(histories):
+    """
+    (day, symbol, bar index) of every bar of every symbol, in date order: a heap
+    merge of the symbols, so one pass over the union of the bars.
+    """
+    return heapq.merge(*[symbol_bars(symbol, history.days) for symbol, history in histories.items()])
+
+def simulate(signals, type, histories, capital=CAPITAL, max_positions=MAX_POSITIONS, size=POSITION_SIZE,
+        per_symbol=1, target='target_15'):
+    """
+    Sweep the bars once, see the module docstring.
+    Returns the equity curve and the trades as DataFrames, and {reason: signals rejected}.
+    """
+    thresholds = backtest.BUY_THRESHOLDS if type == 'buy' else backtest.SELL_THRESHOLDS
+    side = 1 if type == 'buy' else -1
+
+    # Signals waiting for the first bar of their symbol on or after their date
+    waiting = defaultdict(deque)
+    rejected = Counter()
+    for signal in sorted(signals, key=lambda signal: (signal.day, signal.sequence)):
+        if signal.symbol in histories:
+            waiting[signal.symbol].append(signal)
+        else:
+            rejected['no data'] += 1
+
+    cash = capital
+    equity = capital
+    positions = defaultdict(list)
+    open_count = 0
+    last_close = {}
+    curve = []
+    trades = []
+
+    def close_position(position, bar, day, price, reason):
+        nonlocal cash, open_count
+        pnl = side * position.shares * (price - position.price)
+        # Long: the sale. Short: the margin back plus the profit.
+        cash += position.shares * position.price + pnl
+        open_count -= 1
+        trades.append({
+            "Symbol": position.signal.symbol,
+            "Signal Date": position.signal.date,
+            "Entry Date": nse_calendar.from_day_number(histories[position.signal.symbol].days[position.entry_bar]),
+            "Entry Price": position.price,
+            "Shares": position.shares,
+            "Exit Date": nse_calendar.from_day_number(day),
+            "Exit Price": price,
+            "Reason": reason,
+            "Bars": bar - position.entry_bar,
+            "PnL": pnl,
+            "Return %": 100 * side * (price / position.price - 1),
+        })
+
+    for day, bars in itertools.groupby(bar_stream(histories), key=lambda bar: bar[0]):
+        bars = list(bars)
+
+        # Exits
+        for _, symbol, i in bars:
+            if not positions[symbol]:
+                continue
+            history = histories[symbol]
+            still_open = []
+            for position in positions[symbol]:
+                if i <= position.entry_bar:
+                    still_open.append(position)
+                elif side * (history.close[i] - position.stoploss) < 0:
+                    close_position(position, i, day, history.close[i], 'stoploss')
+                elif side * ((history.high[i] if side > 0 else history.low[i]) - position.target) > 0:
+                    close_position(position, i, day, position.target, 'target')
+                elif i >= position.last_bar:
+                    close_position(position, i, day, history.close[i], 'window end')
+                else:
+                    still_open.append(position)
+            positions[symbol] = still_open
+
+        # Entries, in file order
+        due = []
+        for _, symbol, i in bars:
+            queue = waiting.get(symbol)
+            while queue and queue[0].day <= day:
+                due.append((queue.popleft(), i))
+        due.sort(key=lambda entry: entry[0].sequence)
+
+        for signal, i in due:
+            history = histories[signal.symbol]
+            last_bar = int(np.searchsorted(history.days, signal.end_day, side='right')) - 1
+            if day > signal.end_day or last_bar <= i:
+                rejected['no data'] += 1
+                continue
+            if open_count >= max_positions:
+                rejected['max positions'] += 1
+                continue
+            if len(positions[signal.symbol]) >= per_symbol:
+                rejected['per symbol'] += 1
+                continue
+
+            price = history.close[i]
+            shares = math.floor(min(size * equity, cash) / price) if price > 0 else 0
+            if shares < 1:
+                rejected['cash'] += 1
+                continue
+
+            cash -= shares * price
+            open_count += 1
+            positions[signal.symbol].append(Position(signal, i, last_bar, price, shares,
+                price * thresholds[target], price * thresholds['stoploss']))
+
+        # Mark to market
+        for _, symbol, i in bars:
+            last_close[symbol] = histories[symbol].close[i]
+        value = sum(position.shares * (position.price + side * (last_close[symbol] - position.price))
+                for symbol, symbol_positions in positions.items() for position in symbol_positions)
+        equity = cash + value
+        curve.append((nse_calendar.from_day_number(day), cash, value, equity, open_count))
+
+    curve = pd.DataFrame(curve, columns=["Date", "Cash", "Positions", "Equity", "Open"])
+    trades = pd.DataFrame(trades, columns=["Symbol", "Signal Date", "Entry Date", "Entry Price", "Shares",
+        "Exit Date", "Exit Price", "Reason", "Bars", "PnL", "Return %"])
+    for df, columns in ((curve, ["Date"]), (trades, ["Signal Date", "Entry Date", "Exit Date"])):
+        for c in columns:
+            df[c] = pd.to_datetime(df[c])
+    return curve, trades, rejected
+
+def summarize(curve, trades, rejected, capital):
+    if curve.empty:
+        return {'trades': 0, 'rejected': dict(rejected)}
+
+    equity = curve["Equity"].to_numpy()
+    drawdown = 1 - equity / np.maximum.accumulate(equity)
+    return {
+        'start': curve["Date"].iloc[0].strftime('%d-%m-%Y'),
+        'end': curve["Date"].iloc[-1].strftime('%d-%m-%Y'),
+        'final_equity': float(equity[-1]),
+        'return_pct': 100 * float(equity[-1] / capital - 1),
+        'max_drawdown_pct': 100 * float(drawdown.max()),
+        'trades': len(trades),
+        'win_rate_pct': 100 * float((trades["PnL"] > 0).mean()) if len(trades) else 0.0,
+        'mean_return_pct': float(trades["Return %"].mean()) if len(trades) else 0.0,
+        'exits': dict(Counter(trades["Reason"])),
+        'max_open': int(curve["Open"].max()),
+        'exposure_pct': 100 * float((curve["Positions"] / curve["Equity"]).mean()),
+        'rejected': dict(rejected),
+    }
+
+def run_portfolio(backtest_file, type, capital=CAPITAL, max_positions=MAX_POSITIONS, size=POSITION_SIZE,
+        per_symbol=1, target='target_15', fetch_workers=nse_fetch.FETCH_WORKERS):
+    """
+    Simulate the signal file, write the equity curve and the trades and return the summary.
+    """
+    signals = read_signals(backtest_file)
+    histories = load_histories(signals, fetch_workers)
+    curve, trades, rejected = simulate(signals, type, histories, capital, max_positions, size, per_symbol, target)
+
+    for path, df in ((equity_file, curve), (trades_file, trades)):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        df.to_csv(path, index=False, date_format='%d-%m-%Y')
+
+    summary = summarize(curve, trades, rejected, capital)
+    logging.info("Portfolio of {} signals: {}".format(len(signals), summary))
+    return summary
+
+def main():
+    backtest.setup_logging()
+
+    parser = argparse.ArgumentParser(
+            description="""
+            ==============================
+            Simulate a signal file as one portfolio
+            ==============================
+            """
+            )
+
+    parser.add_argument('--file', metavar='file', help='signal csv file with symbol and date columns', type=str, default="../data/backtest_data.csv")
+    parser.add_argument('--type', metavar='type', help='buy or sell', type=str, default='buy')
+    parser.add_argument('--capital', metavar='capital', help='starting capital (default {:.0f})'.format(CAPITAL), type=float, default=CAPITAL)
+    parser.add_argument('--max_positions', metavar='max_positions', help='open positions at most (default {})'.format(MAX_POSITIONS), type=int, default=MAX_POSITIONS)
+    parser.add_argument('--size', metavar='size', help='part of the equity put in a new position (default {})'.format(POSITION_SIZE), type=float, default=POSITION_SIZE)
+    parser.add_argument('--per_symbol', metavar='per_symbol', help='open positions per symbol at most (default 1)', type=int, default=1)
+    parser.add_argument('--target', metavar='target', help='target_15 or target_20', type=str, default='target_15')
+    parser.add_argument('--store', metavar='store', help='price history store: sqlite, parquet, feather or mmap', type=str, default='sqlite')
+
+    args = parser.parse_args()
+
+    if args.type not in ('buy', 'sell'):
+        print("--type should be buy or sell.")
+        sys.exit(0)
+    if args.target not in ('target_15', 'target_20'):
+        print("--target should be target_15 or target_20.")
+        sys.exit(0)
+
+    backtest.use_store(args.store)
+    summary = run_portfolio(args.file, args.type, args.capital, args.max_positions, args.size, args.per_symbol, args.target)
+    for name, value in summary.items():
+        print("{:18} {}".format(name, value))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+#!/home/mansuman/venv/bin/python
+import os
+import sys
+import argparse
+import sqlite3
+import logging
+from pathlib import Path
+from datetime import datetime as dt
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+
+from backtest_stats import stats
+
+
+"""
+Backtest results store.
+Results go into the RESULTS table of ../data/backtest_results.db, one typed row
+per (Symbol, Date, Side, Params), where Params are the thresholds the result was
+computed with. Backtesting the same signal again with the same thresholds
+replaces its row instead of adding one.
+Rows are buffered and written batch_size at a time in one transaction, by one
+writer (in a parallel batch, the parent). Date is a day number, like in NSECACHE.
+Load them with ResultsStore.read(), or export them with:
+    ./backtest_results.py --export ../data/backtest_results.csv   (or .parquet)
+
+Run manifest.
+The RUNS table has the state of every (Symbol, Date, Side, Params) that was
+backtested: Status (done or failed), the Error of a failed run, Attempts, and
+when it was Started (first attempt) and Updated (last attempt). It is written in
+the same transaction as the results, so a run is done exactly when its results
+row is stored. A batch that was stopped resumes by skipping what runs() says is
+done, which is one indexed query per chunk of the signal file. List the failed
+runs with:
+    ./backtest_results.py --failed
+"""
+RESULTS_COLUMNS = [
+        ("Symbol", "TEXT NOT NULL"),
+        ("Date", "INTEGER NOT NULL"),
+        ("Side", "TEXT NOT NULL"),
+        ("Params", "TEXT NOT NULL"),
+        ("Price", "REAL"),
+        ("Stoploss", "REAL"),
+        ("Target 15", "REAL"),
+        ("Max Correction %", "REAL"),
+        ("Result 15", "TEXT"),
+        ("Time Taken 15", "INTEGER"),
+        ("Target 20", "REAL"),
+        ("Time Taken 20", "INTEGER"),
+        ("Result 20", "TEXT"),
+        # High in 3/6 months for buy, low for sell
+        ("Best 3 Months", "REAL"),
+        ("Best 6 Months", "REAL"),
+        ("Updated", "TEXT"),
+        ]
+RESULTS_KEY = ["Symbol", "Date", "Side", "Params"]
+
+RUN_DONE = 'done'
+RUN_FAILED = 'failed'
+
+def params_key(thresholds):
+    """
+    Params of a dict of threshold name -> multiplier, e.g. "stoploss=0.95,target_15=1.03,target_20=1.05".
+    """
+    return ",".join("{}={}".format(name, thresholds[name]) for name in sorted(thresholds))
+
+def results_table_sql():
+    columns = ",\n".join('    "{}" {}'.format(name, type) for name, type in RESULTS_COLUMNS)
+    key = ", ".join('"{}"'.format(c) for c in RESULTS_KEY)
+    return 'CREATE TABLE IF NOT EXISTS "RESULTS" (\n{},\n    PRIMARY KEY ({})\n) WITHOUT ROWID'.format(columns, key)
+
+def runs_table_sql():
+    return '''CREATE TABLE IF NOT EXISTS "RUNS" (
+    "Symbol" TEXT NOT NULL,
+    "Date" INTEGER NOT NULL,
+    "Side" TEXT NOT NULL,
+    "Params" TEXT NOT NULL,
+    "Status" TEXT NOT NULL,
+    "Error" TEXT,
+    "Attempts" INTEGER NOT NULL,
+    "Started" TEXT NOT NULL,
+    "Updated" TEXT NOT NULL,
+    PRIMARY KEY ("Symbol", "Date", "Side", "Params")
+) WITHOUT ROWID'''
+
+def to_day(d):
+    return (d - dt(1970, 1, 1).date()).days
+
+class ResultsStore:
+    def __init__(self, location, batch_size=1000):
+        self.location = location
+        self.batch_size = batch_size
+        self.buffer = []
+        # (Symbol, Date, Side, Params, Status, Error, time) of the buffered runs
+        self.run_buffer = []
+        self.conn = None
+
+    def connect(self):
+        if self.conn is None:
+            Path(self.location).parent.mkdir(parents=True, exist_ok=True)
+            self.conn = sqlite3.connect(self.location, timeout=30)
+            self.conn.execute("PRAGMA journal_mode = WAL")
+            self.conn.execute("PRAGMA synchronous = NORMAL")
+            with self.conn:
+                self.conn.execute(results_table_sql())
+                self.conn.execute(runs_table_sql())
+                self.conn.execute('CREATE INDEX IF NOT EXISTS "ix_RUNS_Side_Params" ON "RUNS" ("Side", "Params", "Status")')
+        return self.conn
+
+    def add(self, row):
+        """
+        Buffer one result, a dict of RESULTS_COLUMNS (Date a date), and mark its run done.
+        Writes the buffer once it is full.
+        """
+        now = dt.now().isoformat(timespec='seconds')
+        self.buffer.append(dict(row, Updated=now))
+        self.run_buffer.append(tuple(row[c] for c in RESULTS_KEY) + (RUN_DONE, None, now))
+        if len(self.buffer) + len(self.run_buffer) >= 2 * self.batch_size:
+            self.flush()
+
+    def add_failure(self, symbol, date, side, params, error):
+        """
+        Buffer a failed run of (symbol, date, side, params) with the error text.
+        """
+        now = dt.now().isoformat(timespec='seconds')
+        self.run_buffer.append((symbol, date, side, params, RUN_FAILED, error, now))
+        if len(self.buffer) + len(self.run_buffer) >= 2 * self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered results and runs in one transaction.
+        """
+        if not self.buffer and not self.run_buffer:
+            return 0
+
+        names = [name for name, type in RESULTS_COLUMNS]
+        rows = []
+        for row in self.buffer:
+            values = dict(row)
+            values["Date"] = to_day(values["Date"])
+            # numpy scalars (prices, bar counts) as plain python values for sqlite3
+            rows.append(tuple(v.item() if isinstance(v, np.generic) else v for v in (values.get(name) for name in names)))
+
+        columns = ", ".join('"{}"'.format(name) for name in names)
+        params = ", ".join("?" for name in names)
+        key = ", ".join('"{}"'.format(c) for c in RESULTS_KEY)
+        updates = ", ".join('"{0}" = excluded."{0}"'.format(name) for name in names if name not in RESULTS_KEY)
+        cmd = 'INSERT INTO "RESULTS" ({}) VALUES ({}) ON CONFLICT ({}) DO UPDATE SET {}'.format(columns, params, key, updates)
+
+        runs = [(symbol, to_day(date), side, params, status, error, now, now)
+                for symbol, date, side, params, status, error, now in self.run_buffer]
+        runs_cmd = '''INSERT INTO "RUNS" ("Symbol", "Date", "Side", "Params", "Status", "Error", "Attempts", "Started", "Updated")
+                VALUES (?, ?, ?, ?, ?, ?, 1, ?, ?)
+                ON CONFLICT ("Symbol", "Date", "Side", "Params") DO UPDATE SET
+                "Status" = excluded."Status", "Error" = excluded."Error",
+                "Attempts" = "RUNS"."Attempts" + 1, "Updated" = excluded."Updated"'''
+
+        conn = self.connect()
+        with stats.stage('results_flush'), conn:
+            conn.executemany(cmd, rows)
+            conn.executemany(runs_cmd, runs)
+
+        logging.info("Wrote {} results, {} runs to {}".format(len(rows), len(runs), self.location))
+        self.buffer = []
+        self.run_buffer = []
+        return len(rows)
+
+    def close(self):
+        self.flush()
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def read(self, side=None):
+        """
+        All results (of side) as a DataFrame with a datetime Date column.
+        """
+        if Path(self.location).is_file() is False:
+            return pd.DataFrame(columns=[name for name, type in RESULTS_COLUMNS])
+
+        query = 'SELECT * FROM "RESULTS"'
+        params = ()
+        if side is not None:
+            query += ' WHERE "Side" = ?'
+            params = (side,)
+
+        df = pd.read_sql_query(query, self.connect(), params=params)
+        df["Date"] = pd.to_datetime(df["Date"].to_numpy(dtype='int64').astype('datetime64[D]'))
+        for c in ("Symbol", "Side", "Params", "Result 15", "Result 20"):
+            df[c] = df[c].astype('category')
+        return df
+
+    def get(self, symbol, date, side, params):
+        """
+        The stored result of one run as a dict of RESULTS_COLUMNS (Date a date), None if there is none.
+        """
+        if Path(self.location).is_file() is False:
+            return None
+
+        cursor = self.connect().execute('SELECT * FROM "RESULTS" WHERE "Symbol" = ? AND "Date" = ? AND "Side" = ? AND "Params" = ?',
+                (symbol, to_day(date), side, params))
+        values = cursor.fetchone()
+        if values is None:
+            return None
+
+        row = dict(zip([c[0] for c in cursor.description], values))
+        row["Date"] = dt(1970, 1, 1).date() + timedelta(days=row["Date"])
+        return row
+
+    def runs(self, side, params, symbols=None):
+        """
+        {(symbol, date): status} of every recorded run of side with params (and of symbols).
+        """
+        if Path(self.location).is_file() is False:
+            return {}
+
+        query = 'SELECT "Symbol", "Date", "Status" FROM "RUNS" WHERE "Side" = ? AND "Params" = ?'
+        if symbols is None:
+            rows = self.connect().execute(query, (side, params)).fetchall()
+        else:
+            # In parts, to stay under the SQL variable limit of older sqlite versions
+            symbols = sorted(set(symbols))
+            rows = []
+            for i in range(0, len(symbols), 500):
+                part = symbols[i:i + 500]
+                rows += self.connect().execute(query + ' AND "Symbol" IN ({})'.format(", ".join("?" for s in part)),
+                        (side, params) + tuple(part)).fetchall()
+        epoch = dt(1970, 1, 1).date()
+        return {(symbol, epoch + timedelta(days=day)): status for symbol, day, status in rows}
+
+    def status(self, symbol, date, side, params):
+        """
+        Status of one run, None if it never ran.
+        """
+        if Path(self.location).is_file() is False:
+            return None
+
+        row = self.connect().execute('SELECT "Status" FROM "RUNS" WHERE "Symbol" = ? AND "Date" = ? AND "Side" = ? AND "Params" = ?',
+                (symbol, to_day(date), side, params)).fetchone()
+        return None if row is None else row[0]
+
+    def failed_runs(self):
+        """
+        All failed runs, most recent first.
+        """
+        if Path(self.location).is_file() is False:
+            return []
+
+        return self.connect().execute(
+                '''SELECT "Symbol", date("Date" * 86400, 'unixepoch'), "Side", "Params", "Attempts", "Updated", "Error"
+                FROM "RUNS" WHERE "Status" = ? ORDER BY "Updated" DESC''', (RUN_FAILED,)).fetchall()
+
+def export(store, path):
+    """
+    Write all results to path, as Parquet if it ends in .parquet, else as csv.
+    """
+    df = store.read()
+    tmp_path = path + ".tmp"
+    if path.endswith(".parquet"):
+        df.to_parquet(tmp_path, index=False)
+    else:
+        df.to_csv(tmp_path, index=False, date_format='%d-%m-%Y')
+    os.replace(tmp_path, path)
+    logging.info("Exported {} results to {}".format(len(df), path))
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(
+            description="""
+            ==============================
+            Backtest results
+            ==============================
+            """
+            )
+
+    parser.add_argument('--db', metavar='db', help='results database', type=str, default="../data/backtest_results.db")
+    parser.add_argument('--export', metavar='path', help='export the results to a .csv or .parquet file', type=str)
+    parser.add_argument('--failed', help='list the failed runs', action='store_true', default=False)
+
+    args = parser.parse_args()
+
+    if not args.export and not args.failed:
+        parser.print_help()
+        sys.exit(0)
+
+    store = ResultsStore(args.db)
+
+    if args.failed:
+        for symbol, date, side, params, attempts, updated, error in store.failed_runs():
+            print("{} {} {} [{}] attempts {} last {}: {}".format(symbol, date, side, params, attempts, updated, error))
+
+    if args.export:
+        export(store, args.export)
+
+
+if __name__ == "__main__":
+    main()
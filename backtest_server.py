@@ -0,0 +1,275 @@
+#!/home/mansuman/venv/bin/python
+import os
+import sys
+import json
+import time
+import queue
+import signal
+import socket
+import argparse
+import logging
+import threading
+import socketserver
+from datetime import date
+from datetime import datetime as dt
+import numpy as np
+
+import backtest
+from backtest import NSEDB, BacktestError
+from backtest_results import RUN_DONE
+from backtest_stats import stats
+from backtest_client import SOCKET_PATH, encode
+
+
+"""
+Backtest daemon.
+Keeps one process with pandas imported, the cache open and the parsed price
+history in price_cache, and backtests the jobs of ./backtest_client.py (or of
+backtest_client.Client) sent over a Unix domain socket:
+    ./backtest_server.py --store sqlite &
+    ./backtest_client.py --symbol INFY --date 01-02-2021 --price 0 --type buy
+Connections are served by threads, which only read and write json lines. The
+jobs themselves run one at a time on the main thread, which is the only one
+touching the cache, price_cache and the results store. Results are flushed after
+every job, so they are in the results store when the reply goes out.
+Other processes (./backtest.py --update_db, a batch) may write to the cache
+while the daemon runs. The daemon watches PRAGMA data_version and drops
+price_cache when somebody else has written. A recompiled mmap store is only
+picked up after a restart.
+"""
+
+class CacheWatch:
+    """
+    Tells whether another process has written to nsecache since the last look.
+    PRAGMA data_version of a connection moves with the commits of every other
+    connection, not with its own. It is read on the writer of NSEDB, so what
+    this process writes itself (prices, coverage) does not count, whenever it
+    happens, and anybody else's write between two looks always does.
+    """
+    def __init__(self):
+        self.version = self.data_version()
+
+    def data_version(self):
+        with NSEDB().write() as conn:
+            return conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def changed(self):
+        version = self.data_version()
+        changed = version != self.version
+        self.version = version
+        return changed
+
+def to_json(value):
+    # Values of results rows which json does not know
+    if isinstance(value, date):
+        return value.strftime('%d-%m-%Y')
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("Can not send {!r}".format(value))
+
+class Handler(socketserver.StreamRequestHandler):
+    """
+    One connection: any number of requests, one json line each, answered in order.
+    """
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("a request is a json object")
+            except ValueError as e:
+                reply = {'ok': False, 'error': "Bad request: {}".format(str(e))}
+            else:
+                done = queue.Queue(1)
+                self.server.jobs.put((request, done))
+                reply = done.get()
+
+            try:
+                self.wfile.write(json.dumps(reply, default=to_json).encode() + b"\n")
+            except (TypeError, ValueError) as e:
+                self.wfile.write(encode({'ok': False, 'error': "Could not send the reply: {}".format(str(e))}))
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        self.jobs = queue.Queue()
+        super().__init__(path, Handler)
+
+class Daemon:
+    def __init__(self, path=SOCKET_PATH, store='sqlite'):
+        self.path = path
+        self.store = store
+        self.server = None
+        self.watch = None
+        self.running = False
+
+    def start(self):
+        backtest.use_store(self.store)
+        # Open the cache (and bring its schema up to date) before taking jobs.
+        NSEDB()
+        self.watch = CacheWatch()
+
+        remove_stale_socket(self.path)
+        self.server = Server(self.path)
+        # Only this user may send jobs.
+        os.chmod(self.path, 0o600)
+        threading.Thread(target=self.server.serve_forever, name="backtest_server", daemon=True).start()
+        self.running = True
+        logging.info("Backtest daemon {} listening on {} ({} store)".format(os.getpid(), self.path, self.store))
+
+    def run(self):
+        """
+        Run the jobs until a shutdown request (or SIGTERM/SIGINT).
+        """
+        try:
+            while self.running:
+                request, done = self.server.jobs.get()
+                done.put(self.execute(request))
+        finally:
+            self.stop()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+        self.watch = None
+        backtest.results.close()
+        logging.info("Backtest daemon stopped")
+
+    def execute(self, request):
+        """
+        The reply to one request. A request never takes the daemon down.
+        """
+        start = time.perf_counter()
+        op = request.get('op')
+        try:
+            if op == 'backtest':
+                reply = self.backtest(request)
+            elif op == 'update_db':
+                self.use_store(request.get('store'))
+                backtest.update_db()
+                reply = {'ok': True}
+            elif op == 'migrate_db':
+                reply = self.migrate_db()
+            elif op == 'stats':
+                reply = dict(ok=True, price_cache=backtest.price_cache.stats(), **stats.summary())
+            elif op == 'ping':
+                reply = {'ok': True, 'pid': os.getpid(), 'store': backtest.store.name}
+            elif op == 'shutdown':
+                self.running = False
+                reply = {'ok': True}
+            else:
+                reply = {'ok': False, 'error': "Unknown op {!r}".format(op)}
+        except Exception as e:
+            logging.exception("Request {} failed: {}".format(request, str(e)))
+            reply = {'ok': False, 'error': repr(e)}
+        finally:
+            # Whatever the request got to, its results are written before the reply.
+            backtest.results.flush()
+
+        reply['elapsed_ms'] = 1000 * (time.perf_counter() - start)
+        return reply
+
+    def use_store(self, name):
+        if name is not None and name != backtest.store.name:
+            logging.info("Switching to the {} store".format(name))
+            backtest.use_store(name)
+            self.store = name
+
+    def backtest(self, request):
+        """
+        A job of ./backtest.py: skipped when done before (unless rerun), else backtested
+        and its result or failure recorded.
+        """
+        symbol = request.get('symbol')
+        type = request.get('type')
+        if not symbol or type not in ('buy', 'sell'):
+            return {'ok': False, 'error': "A backtest needs a symbol and a type of buy or sell"}
+        try:
+            entry_date = dt.strptime(request.get('date') or '', '%d-%m-%Y').date()
+        except ValueError:
+            return {'ok': False, 'error': "date should be dd-mm-yyyy, not {!r}".format(request.get('date'))}
+
+        self.use_store(request.get('store'))
+        if self.watch.changed():
+            logging.info("nsecache was written by another process, dropping the price cache")
+            backtest.price_cache.clear()
+
+        logging.info("Starting backtesting for symbol {} date {} buy price {}".format(symbol, request['date'], request.get('price')))
+        params = backtest.side_params(type)
+        if not request.get('rerun') and backtest.results.status(symbol, entry_date, type, params) == RUN_DONE:
+            return {'ok': True, 'status': 'skipped', 'row': backtest.results.get(symbol, entry_date, type, params)}
+
+        try:
+            row = backtest.run_backtest(symbol, request['date'], request.get('price'), type)
+        except BacktestError as e:
+            backtest.results.add_failure(symbol, entry_date, type, params, str(e))
+            return {'ok': False, 'status': 'failed', 'error': str(e)}
+        finally:
+            backtest.results.flush()
+
+        return {'ok': True, 'status': 'done', 'row': row}
+
+    def migrate_db(self):
+        NSEDB.reset()
+        backtest.migrate_db()
+        NSEDB()
+        backtest.price_cache.clear()
+        self.watch = CacheWatch()
+        return {'ok': True}
+
+def remove_stale_socket(path):
+    """
+    Remove the socket file of a daemon that is gone. Exits if one is still listening.
+    """
+    if not os.path.exists(path):
+        return
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        os.unlink(path)
+        return
+    finally:
+        sock.close()
+
+    logging.error("A backtest daemon is already listening on {}".format(path))
+    sys.exit(1)
+
+def stop_on_signal(signum, frame):
+    # Leave run() through its finally, which closes the socket and the results store.
+    sys.exit(0)
+
+def main():
+    backtest.setup_logging()
+
+    parser = argparse.ArgumentParser(
+            description="""
+            ==============================
+            Backtest daemon
+            ==============================
+            """
+            )
+
+    parser.add_argument('--socket', metavar='socket', help='socket to listen on (default {})'.format(SOCKET_PATH), type=str, default=SOCKET_PATH)
+    parser.add_argument('--store', metavar='store', help='price history store: sqlite, parquet, feather or mmap', type=str, default='sqlite')
+    parser.add_argument('--cache_mb', metavar='cache_mb', help='memory for parsed price history (default 256)', type=int, default=256)
+
+    args = parser.parse_args()
+
+    backtest.price_cache.max_bytes = args.cache_mb * 1024 * 1024
+    signal.signal(signal.SIGTERM, stop_on_signal)
+    signal.signal(signal.SIGINT, stop_on_signal)
+
+    daemon = Daemon(args.socket, args.store)
+    daemon.start()
+    daemon.run()
+
+
+if __name__ == "__main__":
+    main()
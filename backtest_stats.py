@@ -0,0 +1,176 @@
+import time
+import heapq
+import random
+import marshal
+import pstats
+import cProfile
+import logging
+from pathlib import Path
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+import numpy as np
+
+
+"""
+Pipeline instrumentation.
+stats records how long each stage of the pipeline takes (stage() / timed()) and
+counts things like rows read and fetches (count()). It costs two perf_counter()
+calls per stage, so it is always on. Per stage the count, total and max are
+exact; the percentiles come from a random sample of at most MAX_SAMPLES timings,
+so memory does not grow with the size of a batch.
+Batch workers send their take() to the parent, which merge()s them. summary()
+is what process_backtest_data_file writes as json at the end of a batch.
+"""
+MAX_SAMPLES = 10000
+
+class Stage:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = []
+
+    def add(self, elapsed):
+        self.count += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        # Reservoir sampling: every timing has the same chance to be in samples.
+        if len(self.samples) < MAX_SAMPLES:
+            self.samples.append(elapsed)
+        else:
+            i = random.randrange(self.count)
+            if i < MAX_SAMPLES:
+                self.samples[i] = elapsed
+
+    def merge(self, other):
+        samples = self.samples + other.samples
+        if len(samples) > MAX_SAMPLES:
+            samples = random.sample(samples, MAX_SAMPLES)
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        self.samples = samples
+
+    def summary(self):
+        ms = np.asarray(self.samples) * 1000
+        return {
+            'count': self.count,
+            'total_s': self.total,
+            'mean_ms': 1000 * self.total / self.count if self.count else 0.0,
+            'p50_ms': float(np.percentile(ms, 50)) if ms.size else 0.0,
+            'p90_ms': float(np.percentile(ms, 90)) if ms.size else 0.0,
+            'p99_ms': float(np.percentile(ms, 99)) if ms.size else 0.0,
+            'max_ms': 1000 * self.max,
+        }
+
+class Stats:
+    def __init__(self):
+        self.stages = {}
+        self.counters = Counter()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def timed(self, name):
+        """
+        Decorator: time every call of the function as stage name.
+        """
+        def decorator(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def add(self, name, elapsed):
+        if name not in self.stages:
+            self.stages[name] = Stage()
+        self.stages[name].add(elapsed)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def take(self):
+        """
+        Everything recorded so far, which is then forgotten. For merge() in another process.
+        """
+        taken = (self.stages, self.counters)
+        self.stages = {}
+        self.counters = Counter()
+        return taken
+
+    def merge(self, taken):
+        stages, counters = taken
+        for name, stage in stages.items():
+            if name not in self.stages:
+                self.stages[name] = Stage()
+            self.stages[name].merge(stage)
+        self.counters.update(counters)
+
+    def summary(self):
+        return {
+            'stages': {name: stage.summary() for name, stage in sorted(self.stages.items())},
+            'counters': dict(sorted(self.counters.items())),
+        }
+
+stats = Stats()
+
+class SlowestProfiles:
+    """
+    cProfile data of the n slowest calls run under profile().
+    """
+    def __init__(self, n):
+        self.n = n
+        # Min-heap of (elapsed, sequence, label, profile stats), the fastest on top
+        self.heap = []
+        self.sequence = 0
+
+    @contextmanager
+    def profile(self, label):
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            elapsed = time.perf_counter() - start
+            if len(self.heap) < self.n or elapsed > self.heap[0][0]:
+                profiler.create_stats()
+                self.add(elapsed, label, profiler.stats)
+
+    def add(self, elapsed, label, profile_stats):
+        self.sequence += 1
+        heapq.heappush(self.heap, (elapsed, self.sequence, label, profile_stats))
+        if len(self.heap) > self.n:
+            heapq.heappop(self.heap)
+
+    def take(self):
+        taken = [(elapsed, label, profile_stats) for elapsed, sequence, label, profile_stats in self.heap]
+        self.heap = []
+        return taken
+
+    def merge(self, taken):
+        for elapsed, label, profile_stats in taken:
+            self.add(elapsed, label, profile_stats)
+
+    def dump(self, directory):
+        """
+        One .prof file (for pstats/snakeviz) and one .txt with the top functions per call, slowest first.
+        """
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        for rank, (elapsed, sequence, label, profile_stats) in enumerate(sorted(self.heap, reverse=True), 1):
+            path = Path(directory) / "{:02d}_{}".format(rank, label)
+            with open(str(path) + ".prof", "wb") as fh:
+                marshal.dump(profile_stats, fh)
+            with open(str(path) + ".txt", "w") as fh:
+                fh.write("{} took {:.1f} ms\n".format(label, 1000 * elapsed))
+                pstats.Stats(str(path) + ".prof", stream=fh).sort_stats('cumulative').print_stats(25)
+            logging.info("Profile of {} ({:.1f} ms) in {}.prof".format(label, 1000 * elapsed, path))
@@ -0,0 +1,157 @@
+#!/home/mansuman/venv/bin/python
+import sys
+import time
+import argparse
+import logging
+import warnings
+from collections import Counter
+import numpy as np
+import pandas as pd
+
+import backtest
+import nse_fetch
+import process_backtest_data_file as batch
+from backtest import BacktestError
+from backtest_kernel import sweep_buy, sweep_sell, price_arrays
+
+
+"""
+Target/stoploss sweep.
+Instead of editing the thresholds in backtest_buy/backtest_sell and running the
+whole signal file again, every combination of a grid of target and stoploss
+percentages is evaluated for every signal, with the price window of each signal
+loaded once (see backtest_kernel.sweep_buy/sweep_sell). The entry price is the
+Close of the signal date, like price 0 in backtest.py.
+The result is one row per (target, stoploss) with hit rates and times (in bars):
+    ./backtest_sweep.py --file ../data/backtest_data.csv --type buy --targets 3,5,10,15,20 --stoplosses 3,5,10
+"""
+results_file = "../data/sweep_results.csv"
+
+def threshold_prices(price, type, targets, stoplosses):
+    """
+    Target and stoploss prices for percentages targets and stoplosses.
+    """
+    targets = np.asarray(targets, dtype='float64') / 100
+    stoplosses = np.asarray(stoplosses, dtype='float64') / 100
+
+    if type == 'buy':
+        return price * (1 + targets), price * (1 - stoplosses)
+    return price * (1 - targets), price * (1 + stoplosses)
+
+def sweep_signal(symbol, date, type, targets, stoplosses, history=None):
+    """
+    backtest_kernel.sweep_buy/sweep_sell of one signal.
+    """
+    df = backtest.get_backtest_window(symbol, date, history)
+    if df.empty:
+        raise BacktestError("No price data for symbol {} on {}".format(symbol, date))
+
+    high, low, close = price_arrays(df)
+    target_prices, stoploss_prices = threshold_prices(close[0], type, targets, stoplosses)
+
+    if type == 'buy':
+        return sweep_buy(high, low, close, target_prices, stoploss_prices)
+    return sweep_sell(high, low, close, target_prices, stoploss_prices)
+
+def sweep_table(outs, targets, stoplosses):
+    """
+    One row per (target, stoploss) out of the sweep_signal() results of all signals.
+    """
+    target_hit = np.stack([out['target_hit'] for out in outs])
+    sl_hit = np.stack([out['sl_hit'] for out in outs])
+    time_taken = np.where(target_hit, np.stack([out['time_taken'] for out in outs]), np.nan)
+    time_to_sl = np.where(sl_hit, np.stack([out['time_to_sl'] for out in outs]), np.nan)
+
+    signals = len(outs)
+    target_hits = target_hit.sum(axis=0)
+    sl_hits = sl_hit.sum(axis=0)
+
+    # A grid point without hits has all NaN times, and NaN is what its mean should be.
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        mean_time_taken = np.nanmean(time_taken, axis=0)
+        median_time_taken = np.nanmedian(time_taken, axis=0)
+        mean_time_to_sl = np.nanmean(time_to_sl, axis=0)
+
+    grid_target, grid_stoploss = np.meshgrid(targets, stoplosses, indexing='ij')
+    return pd.DataFrame({
+        'target_p': grid_target.ravel(),
+        'stoploss_p': grid_stoploss.ravel(),
+        'signals': signals,
+        'target_hits': target_hits.ravel(),
+        'sl_hits': sl_hits.ravel(),
+        'open': (signals - target_hits - sl_hits).ravel(),
+        'target_hit_rate': (target_hits / signals).ravel(),
+        'sl_hit_rate': (sl_hits / signals).ravel(),
+        'mean_time_taken': mean_time_taken.ravel(),
+        'median_time_taken': median_time_taken.ravel(),
+        'mean_time_to_sl': mean_time_to_sl.ravel(),
+    })
+
+def run_sweep(backtest_file, type, targets, stoplosses, fetch_workers=nse_fetch.FETCH_WORKERS):
+    """
+    Sweep every signal of the signal file and write the table to results_file.
+    """
+    # Without the rows which have no symbol or no valid date (logged), see process_backtest_data_file.parse_signals().
+    chunks = list(batch.parse_signals(batch.read_signals(backtest_file), Counter()))
+    df = pd.concat(chunks) if chunks else pd.DataFrame(columns=['symbol', 'date'])
+    tasks = batch.group_by_symbol(df, type, False)
+    batch.prefetch_tasks(tasks, fetch_workers)
+
+    start = time.perf_counter()
+    outs = []
+    failed = 0
+    for symbol, dates, type, write in tasks:
+        history = batch.symbol_history(symbol, dates)
+        for date in dates:
+            try:
+                outs.append(sweep_signal(symbol, date, type, targets, stoplosses, history))
+            except BacktestError as e:
+                logging.error("Sweep failed for symbol {} date {}: {}".format(symbol, date, str(e)))
+                failed += 1
+
+    logging.info("Swept {} signals over {} grid points in {:.1f}s, {} failed".format(
+        len(outs), len(targets) * len(stoplosses), time.perf_counter() - start, failed))
+
+    if not outs:
+        logging.error("Nothing to sweep in {}".format(backtest_file))
+        return None
+
+    table = sweep_table(outs, targets, stoplosses)
+    table.to_csv(results_file, index=False)
+    return table
+
+def parse_percentages(value):
+    return [float(v) for v in value.split(',') if v.strip()]
+
+def main():
+    backtest.setup_logging()
+
+    parser = argparse.ArgumentParser(
+            description="""
+            ==============================
+            Sweep targets and stoplosses over a signal file
+            ==============================
+            """
+            )
+
+    parser.add_argument('--file', metavar='file', help='signal csv file with symbol and date columns', type=str, default="../data/backtest_data.csv")
+    parser.add_argument('--type', metavar='type', help='buy or sell', type=str, default='buy')
+    parser.add_argument('--targets', metavar='targets', help='comma separated target percentages', type=str, default="3,5,10,15,20")
+    parser.add_argument('--stoplosses', metavar='stoplosses', help='comma separated stoploss percentages', type=str, default="3,5,10")
+    parser.add_argument('--store', metavar='store', help='price history store: sqlite, parquet, feather or mmap', type=str, default='sqlite')
+
+    args = parser.parse_args()
+
+    if args.type not in ('buy', 'sell'):
+        print("--type should be buy or sell.")
+        sys.exit(0)
+
+    backtest.use_store(args.store)
+    table = run_sweep(args.file, args.type, parse_percentages(args.targets), parse_percentages(args.stoplosses))
+    if table is not None:
+        print(table.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
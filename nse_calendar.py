@@ -0,0 +1,187 @@
+#!/home/mansuman/venv/bin/python
+import sys
+import argparse
+import logging
+from pathlib import Path
+from datetime import date
+from datetime import datetime as dt
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+
+
+"""
+NSE trading calendar.
+Trading days are the weekdays, minus the exchange holidays, plus the odd session
+on a weekend (Muhurat trading). Holidays and sessions come from a local file,
+../data/nse_holidays.csv:
+    Date,Type,Description
+    26-01-2021,holiday,Republic Day
+    14-11-2020,session,Muhurat trading
+Without the file every weekday is a trading day. The file can be built from the
+cache, where a weekday on which no symbol traded is a holiday:
+    ./nse_calendar.py --build
+The calendar is a sorted array of trading day numbers (days since 1970-01-01)
+and, for every calendar day, the index of the first trading day on or after it,
+so every lookup is array indexing.
+"""
+holidays_file = "../data/nse_holidays.csv"
+
+FIRST_DAY = date(1990, 1, 1)
+LAST_DAY = date(2040, 12, 31)
+EPOCH = date(1970, 1, 1)
+
+def day_number(d):
+    return (d - EPOCH).days
+
+def from_day_number(n):
+    return EPOCH + timedelta(days=int(n))
+
+class TradingCalendar:
+    def __init__(self, holidays=(), sessions=(), first=FIRST_DAY, last=LAST_DAY):
+        self.first = day_number(first)
+        self.last = day_number(last)
+
+        days = np.arange(self.first, self.last + 1)
+        # 1970-01-01 was a Thursday
+        self.trading = (days + 3) % 7 < 5
+        for d in holidays:
+            if first <= d <= last:
+                self.trading[day_number(d) - self.first] = False
+        for d in sessions:
+            if first <= d <= last:
+                self.trading[day_number(d) - self.first] = True
+
+        # Trading day numbers, and for each calendar day the index of the first trading day on or after it
+        self.sessions = days[self.trading].astype('int32')
+        self.index = np.searchsorted(self.sessions, days).astype('int32')
+
+    def offset(self, d):
+        n = day_number(d)
+        if n < self.first or n > self.last:
+            raise ValueError("{} is outside the trading calendar ({} to {})".format(d, from_day_number(self.first), from_day_number(self.last)))
+        return n - self.first
+
+    def is_trading_day(self, d):
+        return bool(self.trading[self.offset(d)])
+
+    def next_session(self, d):
+        """
+        First trading day on or after d.
+        """
+        return from_day_number(self.sessions[self.index[self.offset(d)]])
+
+    def previous_session(self, d):
+        """
+        Last trading day on or before d.
+        """
+        i = self.index[self.offset(d)]
+        if not self.trading[self.offset(d)]:
+            i -= 1
+        return from_day_number(self.sessions[i])
+
+    def add_sessions(self, d, n):
+        """
+        The trading day n sessions after the first trading day on or after d.
+        """
+        return from_day_number(self.sessions[self.index[self.offset(d)] + n])
+
+    def count_sessions(self, start, end):
+        """
+        Number of trading days in [start, end].
+        """
+        if end < start:
+            return 0
+        return int(self.index[self.offset(end + timedelta(days=1))] - self.index[self.offset(start)])
+
+    def trim(self, start, end):
+        """
+        [start, end] shrunk to its first and last trading day, None if it has none.
+        """
+        if self.count_sessions(start, end) == 0:
+            return None
+        return self.next_session(start), self.previous_session(end)
+
+def read_holidays(path=holidays_file):
+    """
+    (holidays, sessions) of the holidays file, empty if there is none.
+    """
+    if Path(path).is_file() is False:
+        logging.info("No holidays file at {}, every weekday is a trading day".format(path))
+        return [], []
+
+    df = pd.read_csv(path)
+    days = [dt.strptime(d, '%d-%m-%Y').date() for d in df['Date']]
+    holidays = [d for d, type in zip(days, df['Type']) if type == 'holiday']
+    sessions = [d for d, type in zip(days, df['Type']) if type == 'session']
+    return holidays, sessions
+
+_calendar = None
+
+def get_calendar():
+    """
+    The calendar of holidays_file, loaded once.
+    """
+    global _calendar
+    if _calendar is None:
+        holidays, sessions = read_holidays()
+        _calendar = TradingCalendar(holidays, sessions)
+    return _calendar
+
+def build(path=holidays_file):
+    """
+    Write the holidays file from the dates in the cache: weekdays without any rows
+    are holidays, weekend days with rows are sessions. Only as good as the cache
+    is wide, a day on which none of the cached symbols traded looks like a holiday.
+    """
+    from backtest import NSEDB
+
+    db_instance = NSEDB()
+    with db_instance.read() as conn:
+        traded = np.array([row[0] for row in conn.execute('SELECT DISTINCT "Date" FROM "NSECACHE" ORDER BY "Date"')], dtype='int64')
+
+    if traded.size == 0:
+        logging.error("The cache is empty, can not build {}".format(path))
+        return
+
+    days = np.arange(traded[0], traded[-1] + 1)
+    weekday = (days + 3) % 7 < 5
+    has_rows = np.isin(days, traded)
+
+    rows = [(from_day_number(n).strftime('%d-%m-%Y'), 'holiday', '') for n in days[weekday & ~has_rows]]
+    rows += [(from_day_number(n).strftime('%d-%m-%Y'), 'session', '') for n in days[~weekday & has_rows]]
+    rows.sort(key=lambda row: dt.strptime(row[0], '%d-%m-%Y'))
+
+    pd.DataFrame(rows, columns=["Date", "Type", "Description"]).to_csv(path, index=False)
+    logging.info("Wrote {} holidays and sessions from {} to {} to {}".format(
+        len(rows), from_day_number(traded[0]), from_day_number(traded[-1]), path))
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(
+            description="""
+            ==============================
+            NSE trading calendar
+            ==============================
+            """
+            )
+
+    parser.add_argument('--build', help='build the holidays file from nsecache', action='store_true', default=False)
+    parser.add_argument('--date', metavar='date', help='show the day of the week and trading status of a date (dd-mm-yyyy)', type=str)
+
+    args = parser.parse_args()
+
+    if args.build:
+        build()
+        sys.exit(0)
+
+    if args.date:
+        d = dt.strptime(args.date, '%d-%m-%Y').date()
+        cal = get_calendar()
+        status = "trading day" if cal.is_trading_day(d) else "no trading, next session {}".format(cal.next_session(d).strftime('%d-%m-%Y'))
+        print("{} {}".format(d.strftime('%A'), status))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+#!/home/mansuman/venv/bin/python
+import time
+import random
+import argparse
+import logging
+import threading
+from datetime import date
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import pandas as pd
+
+
+"""
+Concurrent, rate limited downloads.
+fetch_many() downloads many (symbol, from, to) ranges at once on a small thread
+pool. get_history splits a range longer than FETCH_PIECE_DAYS into requests of
+its own, on threads of its own, so fetch_one() cuts ranges into pieces of at
+most FETCH_PIECE_DAYS and calls the source once per piece, FETCH_PIECE_WORKERS
+pieces at a time. Every piece takes a token of the TokenBucket all threads
+share, so NSE never sees more than FETCH_RATE requests per second after a burst
+of FETCH_BURST, and a failed piece is retried with exponential backoff.
+With the defaults, the burst covers the pieces of one cold fetch (2017 to
+today is about 28 of them), so a single symbol comes in about as fast as an
+unthrottled get_history. A cold fetch of many symbols is held to 2 pieces per
+second, about 14 seconds per symbol; raise FETCH_RATE if NSE lets you.
+Failures come back as FetchResults with the error set, nothing exits.
+The data source is any callable with get_history's signature
+source(symbol=, start=, end=), so a local fake can stand in for NSE.
+"""
+FETCH_WORKERS = 4
+# Requests per second, and how many may go out at once after a quiet spell
+FETCH_RATE = 2.0
+FETCH_BURST = 32
+FETCH_RETRIES = 3
+# Seconds before the first retry, doubled for every next one
+FETCH_BACKOFF = 1.0
+# Longest range get_history downloads in one request
+FETCH_PIECE_DAYS = 130
+# Pieces of one range downloaded at a time
+FETCH_PIECE_WORKERS = 8
+
+class TokenBucket:
+    """
+    Lets through rate requests per second on average and bursts of up to burst.
+    Safe to share between threads.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # Blocks until a request may go out
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class FetchResult:
+    """
+    Outcome of downloading one range: data_df on success, error (the last exception) on failure.
+    """
+    def __init__(self, symbol, from_date, to_date, data_df=None, error=None, attempts=0, elapsed=0.0):
+        self.symbol = symbol
+        self.from_date = from_date
+        self.to_date = to_date
+        self.data_df = data_df
+        self.error = error
+        self.attempts = attempts
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.error is None
+
+def default_source():
+    from nsepy import get_history
+    return get_history
+
+# Shared by every download of this process unless fetch_one/fetch_many get their own.
+default_bucket = TokenBucket(FETCH_RATE, FETCH_BURST)
+
+def date_pieces(from_date, to_date, days=FETCH_PIECE_DAYS):
+    """
+    (start, end) pieces of from_date..to_date (both included), each of them at most days long.
+    """
+    pieces = []
+    start = from_date
+    while start <= to_date:
+        end = min(start + timedelta(days=days), to_date)
+        pieces.append((start, end))
+        start = end + timedelta(days=1)
+    return pieces
+
+def fetch_piece(symbol, from_date, to_date, source, bucket, retries, backoff):
+    """
+    One request of fetch_one(), retried. Returns (data_df, attempts, error).
+    """
+    error = None
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            # Exponential backoff with some jitter, so retries don't come back in step.
+            time.sleep(backoff * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+
+        bucket.acquire()
+        try:
+            return source(symbol=symbol, start=from_date, end=to_date), attempt + 1, None
+        except Exception as e:
+            error = e
+            logging.warning("Download of {} from {} to {} failed (attempt {}): {}".format(symbol, from_date, to_date, attempt + 1, str(e)))
+    return None, retries + 1, error
+
+def fetch_one(symbol, from_date, to_date, source=None, bucket=None, retries=FETCH_RETRIES, backoff=FETCH_BACKOFF):
+    """
+    Download one range, one request per date_pieces() piece, retrying failed
+    attempts. Returns a FetchResult, failed if any of the pieces failed.
+    """
+    if source is None:
+        source = default_source()
+    if bucket is None:
+        bucket = default_bucket
+
+    start = time.perf_counter()
+    pieces = date_pieces(from_date, to_date)
+    if len(pieces) <= 1:
+        outs = [fetch_piece(symbol, piece_from, piece_to, source, bucket, retries, backoff) for piece_from, piece_to in pieces]
+    else:
+        with ThreadPoolExecutor(max_workers=min(len(pieces), FETCH_PIECE_WORKERS)) as pool:
+            outs = list(pool.map(lambda piece: fetch_piece(symbol, piece[0], piece[1], source, bucket, retries, backoff), pieces))
+
+    attempts = sum(attempts for data_df, attempts, error in outs)
+    errors = [error for data_df, attempts, error in outs if error is not None]
+    if errors:
+        logging.error("Failed to download data for symbol {}: {}".format(symbol, str(errors[0])))
+        return FetchResult(symbol, from_date, to_date, error=errors[0], attempts=attempts, elapsed=time.perf_counter() - start)
+
+    frames = [data_df for data_df, attempts, error in outs]
+    found = [df for df in frames if not df.empty]
+    if found:
+        data_df = pd.concat(found) if len(found) > 1 else found[0]
+    else:
+        data_df = frames[0] if frames else pd.DataFrame()
+    return FetchResult(symbol, from_date, to_date, data_df=data_df, attempts=attempts, elapsed=time.perf_counter() - start)
+
+def fetch_many(requests, source=None, workers=FETCH_WORKERS, bucket=None, retries=FETCH_RETRIES, backoff=FETCH_BACKOFF):
+    """
+    Download a list of (symbol, from_date, to_date) on workers threads.
+    Yields FetchResults as the downloads finish.
+    """
+    if source is None:
+        source = default_source()
+    if bucket is None:
+        bucket = default_bucket
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(fetch_one, symbol, from_date, to_date, source, bucket, retries, backoff)
+                for symbol, from_date, to_date in requests]
+        for future in as_completed(futures):
+            yield future.result()
+
+def fake_source(latency=0.2, failure_rate=0.0):
+    """
+    A get_history stand-in which waits latency seconds and makes up one row per
+    weekday. failure_rate of the calls raise.
+    """
+    def source(symbol, start, end):
+        time.sleep(latency)
+        if random.random() < failure_rate:
+            raise ConnectionError("fake failure")
+        days = pd.bdate_range(start, end)
+        return pd.DataFrame({'Symbol': symbol, 'Close': 100.0}, index=pd.Index(days.date, name='Date'))
+
+    return source
+
+def benchmark(count, workers, rate, latency, failure_rate):
+    """
+    Throughput of fetch_many against fake_source().
+    """
+    source = fake_source(latency, failure_rate)
+    bucket = TokenBucket(rate, max(1, int(rate)))
+    today = date.today()
+    requests = [("SYM{}".format(i), today - timedelta(days=30), today) for i in range(count)]
+
+    start = time.perf_counter()
+    results = list(fetch_many(requests, source=source, workers=workers, bucket=bucket, backoff=0.1))
+    elapsed = time.perf_counter() - start
+
+    failed = [r for r in results if not r.ok]
+    attempts = sum(r.attempts for r in results)
+    print("{} requests, {} workers, rate {}/s, latency {}s: {:.1f}s, {:.1f} requests/s, {} attempts, {} failed".format(
+        count, workers, rate, latency, elapsed, count / elapsed, attempts, len(failed)))
+
+def main():
+    logging.basicConfig(level=logging.ERROR)
+
+    parser = argparse.ArgumentParser(
+            description="""
+            ==============================
+            NSE fetch pipeline benchmark (fake source)
+            ==============================
+            """
+            )
+
+    parser.add_argument('--count', metavar='count', help='number of requests', type=int, default=50)
+    parser.add_argument('--workers', metavar='workers', help='download threads', type=int, default=FETCH_WORKERS)
+    parser.add_argument('--rate', metavar='rate', help='requests per second', type=float, default=FETCH_RATE)
+    parser.add_argument('--latency', metavar='latency', help='seconds per fake request', type=float, default=0.2)
+    parser.add_argument('--failure_rate', metavar='failure_rate', help='share of fake requests which fail', type=float, default=0.0)
+
+    args = parser.parse_args()
+
+    benchmark(args.count, args.workers, args.rate, args.latency, args.failure_rate)
+
+
+if __name__ == "__main__":
+    main()
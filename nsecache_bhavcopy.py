@@ -0,0 +1,176 @@
+#!/home/mansuman/venv/bin/python
+import time
+import argparse
+import logging
+from pathlib import Path
+import pandas as pd
+
+import backtest
+from backtest import NSECACHE_COLUMNS
+
+
+"""
+Bulk load of NSE daily market-wide files (bhavcopies) into the cache.
+Every file holds one day for every symbol, so a directory of them fills the cache
+for the whole market without a single get_history() request. Both layouts are
+understood:
+    sec_bhavdata_full_DDMMYYYY.csv   (with VWAP and delivery columns)
+    cmDDMMMYYYYbhav.csv[.zip]        (the older one, OHLC and volumes only)
+Columns are renamed and converted to what get_history() returns, and the rows
+of many days go into the cache in one transaction.
+The days between the first and the last file are recorded as fetched for every
+symbol in the files, so get_nse_history() does not download them again. The
+directory should have a file for every trading day: a gap of more than
+MAX_GAP_DAYS days between two files is left as not fetched.
+    ./nsecache_bhavcopy.py --dir ../data/bhavcopy
+"""
+# Bhavcopy column -> NSECACHE column
+BHAVCOPY_COLUMNS = {
+        'SYMBOL': 'Symbol',
+        'SERIES': 'Series',
+        'DATE1': 'Date',
+        'TIMESTAMP': 'Date',
+        'PREV_CLOSE': 'Prev Close',
+        'PREVCLOSE': 'Prev Close',
+        'OPEN_PRICE': 'Open',
+        'OPEN': 'Open',
+        'HIGH_PRICE': 'High',
+        'HIGH': 'High',
+        'LOW_PRICE': 'Low',
+        'LOW': 'Low',
+        'LAST_PRICE': 'Last',
+        'LAST': 'Last',
+        'CLOSE_PRICE': 'Close',
+        'CLOSE': 'Close',
+        'AVG_PRICE': 'VWAP',
+        'TTL_TRD_QNTY': 'Volume',
+        'TOTTRDQTY': 'Volume',
+        'TURNOVER_LACS': 'Turnover',
+        'TOTTRDVAL': 'Turnover',
+        'NO_OF_TRADES': 'Trades',
+        'TOTALTRADES': 'Trades',
+        'DELIV_QTY': 'Deliverable Volume',
+        'DELIV_PER': '%Deliverble',
+        }
+
+# Longest run of days without trading we expect (a long weekend plus holidays).
+MAX_GAP_DAYS = 5
+
+def read_bhavcopy(path, series='EQ'):
+    """
+    One daily file as a get_history() style frame indexed by Date, rows of series only.
+    """
+    df = pd.read_csv(path, skipinitialspace=True, dtype=str)
+    df.columns = [c.strip().upper() for c in df.columns]
+    df = df[[c for c in df.columns if c in BHAVCOPY_COLUMNS]]
+
+    # Turnover in lakhs and delivery in percent in the new layout, get_history() has rupees and a fraction.
+    scale = {'TURNOVER_LACS': 100000, 'DELIV_PER': 0.01}
+
+    out = pd.DataFrame(index=df.index)
+    for column in df.columns:
+        name = BHAVCOPY_COLUMNS[column]
+        values = df[column].str.strip()
+        if name in ('Symbol', 'Series'):
+            out[name] = values
+        elif name == 'Date':
+            out[name] = pd.to_datetime(values, format='%d-%b-%Y')
+        else:
+            # '-' for no deliveries and such
+            out[name] = pd.to_numeric(values, errors='coerce') * scale.get(column, 1)
+
+    if series is not None:
+        out = out[out['Series'] == series]
+
+    columns = [c for c in NSECACHE_COLUMNS if c in out.columns]
+    return out[columns].set_index('Date')
+
+def bhavcopy_files(directory):
+    return sorted(p for p in Path(directory).iterdir() if p.is_file() and (p.suffix == '.csv' or p.name.endswith('.csv.zip')))
+
+def trading_runs(dates, max_gap_days=MAX_GAP_DAYS):
+    """
+    Split sorted dates into (first, last) runs without a gap of more than max_gap_days.
+    """
+    runs = []
+    for d in dates:
+        if runs and (d - runs[-1][1]).days <= max_gap_days:
+            runs[-1][1] = d
+        else:
+            runs.append([d, d])
+
+    return [(first, last) for first, last in runs]
+
+def ingest(directory, series='EQ', batch_rows=500000):
+    """
+    Load every daily file of directory into the cache, batch_rows rows per transaction,
+    and record the days they cover.
+    """
+    files = bhavcopy_files(directory)
+    logging.info("Ingesting {} files from {}".format(len(files), directory))
+
+    frames = []
+    pending = 0
+    rows = 0
+    failed = []
+    # Symbols seen on every date
+    symbols = {}
+    start = time.perf_counter()
+
+    for path in files:
+        try:
+            df = read_bhavcopy(path, series)
+        except Exception as e:
+            logging.error("Could not read {}: {}".format(path, str(e)))
+            failed.append(path.name)
+            continue
+
+        for day, day_symbols in df.groupby(level='Date')['Symbol']:
+            symbols.setdefault(day.date(), set()).update(day_symbols)
+
+        frames.append(df)
+        pending += len(df)
+        if pending >= batch_rows:
+            rows += backtest.write_nse_history(pd.concat(frames))
+            frames = []
+            pending = 0
+            elapsed = time.perf_counter() - start
+            logging.info("Ingested {} rows, {:.0f} rows/s".format(rows, rows / elapsed if elapsed > 0 else 0))
+
+    if frames:
+        rows += backtest.write_nse_history(pd.concat(frames))
+
+    for first, last in trading_runs(sorted(symbols)):
+        run_symbols = set().union(*[s for d, s in symbols.items() if first <= d <= last])
+        logging.info("Recording {} to {} as fetched for {} symbols".format(first, last, len(run_symbols)))
+        for symbol in sorted(run_symbols):
+            backtest.record_coverage(symbol, first, last)
+
+    elapsed = time.perf_counter() - start
+    logging.info("Ingest done in {:.1f}s: {} files, {} rows ({:.0f} rows/s), {} files failed".format(
+        elapsed, len(files), rows, rows / elapsed if elapsed > 0 else 0, len(failed)))
+    for name in failed:
+        logging.error("Not ingested: {}".format(name))
+
+def main():
+    backtest.setup_logging()
+
+    parser = argparse.ArgumentParser(
+            description="""
+            ==============================
+            Load NSE daily bhavcopy files into nsecache
+            ==============================
+            """
+            )
+
+    parser.add_argument('--dir', metavar='dir', help='directory of daily bhavcopy csv files', type=str, required=True)
+    parser.add_argument('--series', metavar='series', help='series to load (default EQ, like get_history)', type=str, default='EQ')
+    parser.add_argument('--batch_rows', metavar='batch_rows', help='rows per transaction', type=int, default=500000)
+
+    args = parser.parse_args()
+
+    ingest(args.dir, args.series, args.batch_rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+#!/home/mansuman/venv/bin/python
+import os
+import shutil
+import time
+import argparse
+import logging
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+import backtest
+from backtest import NSEDB, SqliteStore
+
+
+"""
+Memory-mapped OHLCV store.
+The cache is compiled into fixed width column files under .nsecache/mmap/, one
+.npy file per column for the whole universe, sorted by (Symbol, Date):
+    Date.npy                                  int32 day numbers (days since 1970-01-01)
+    Open.npy High.npy Low.npy Close.npy Volume.npy    float64
+    index.csv                                 Symbol, offset, length, and its coverage at compile time
+The files are opened with np.load(mmap_mode='r'), so reading a symbol only slices
+views out of the OS page cache. Worker processes all share the same pages instead
+of each holding a copy.
+This is a read path only. Writes go to nsecache.db (SqliteStore), and symbols
+never compiled are read from there too. So is a symbol whose coverage in
+NSECACHE_COVERAGE is no longer what index.csv has from the compile: some
+process, this one or another, has fetched more of it since.
+Compile (again, after refreshing the cache) with:
+    ./nsecache_mmap.py --compile
+"""
+MMAP_COLUMNS = ["Open", "High", "Low", "Close", "Volume"]
+# First covered date, last covered date and number of intervals of a symbol, as text.
+# Fetching more of a symbol moves at least one of them, see backtest.record_coverage().
+COVERAGE_COLUMNS = ["covered_from", "covered_to", "intervals"]
+COVERAGE_QUERY = 'SELECT "Symbol", MIN("Start"), MAX("End"), COUNT(*) FROM "NSECACHE_COVERAGE"'
+
+class MmapStore:
+    name = 'mmap'
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = NSEDB.working_dir + "mmap/"
+        self.directory = directory
+        self.sqlite_store = SqliteStore()
+        # Symbols known to be written after the compile. Their files are stale.
+        self.stale = set()
+        # {symbol: coverage at compile time}, see coverage_snapshot()
+        self.coverage = {}
+        self.index = {}
+        self.columns = {}
+
+        path = Path(directory)
+        if (path / "index.csv").is_file() is False:
+            logging.info("No compiled mmap store at {}, reading from nsecache.db".format(directory))
+            return
+
+        index_df = pd.read_csv(path / "index.csv", keep_default_na=False, dtype={c: str for c in COVERAGE_COLUMNS})
+        if not set(COVERAGE_COLUMNS) <= set(index_df.columns):
+            logging.info("The mmap store at {} has no coverage snapshot, reading from nsecache.db until it is compiled again".format(directory))
+            return
+        self.index = {symbol: (offset, length) for symbol, offset, length in index_df[["Symbol", "offset", "length"]].itertuples(index=False)}
+        self.coverage = {row[0]: tuple(row[1:]) for row in index_df[["Symbol"] + COVERAGE_COLUMNS].itertuples(index=False)}
+        for column in ["Date"] + MMAP_COLUMNS:
+            self.columns[column] = np.load(path / "{}.npy".format(column), mmap_mode='r')
+
+    def arrays(self, symbol):
+        """
+        Views of all rows of symbol: a dict of column name -> array, 'Date' as day numbers.
+        None if the symbol is not in the compiled files (or is stale).
+        """
+        if symbol not in self.index or symbol in self.stale:
+            return None
+        if coverage_snapshot(symbol) != self.coverage[symbol]:
+            self.stale.add(symbol)
+            return None
+
+        offset, length = self.index[symbol]
+        return {column: values[offset:offset + length] for column, values in self.columns.items()}
+
+    def read_symbol(self, symbol, columns=None):
+        arrays = self.arrays(symbol)
+        if arrays is None:
+            return self.sqlite_store.read_symbol(symbol, columns)
+
+        if columns is None:
+            columns = MMAP_COLUMNS
+        missing = [c for c in columns if c != "Date" and c not in MMAP_COLUMNS]
+        if missing:
+            # Only OHLCV is compiled.
+            return self.sqlite_store.read_symbol(symbol, columns)
+
+        index = pd.DatetimeIndex(arrays["Date"].astype('datetime64[D]'), name='Date')
+        return pd.DataFrame({c: arrays[c] for c in columns if c != "Date"}, index=index, copy=False)
+
+    def write(self, data_df):
+        rows = self.sqlite_store.write(data_df)
+        if not data_df.empty:
+            self.stale.update(data_df['Symbol'].unique())
+        return rows
+
+    def read_panel(self, symbols, fields, start_date, end_date):
+        # Per symbol, the compiled symbols are views anyway.
+        return backtest.stack_panel(self, symbols, fields, start_date, end_date)
+
+    def invalidate(self, symbol):
+        # Written by another process: read it from nsecache.db from now on.
+        self.stale.add(symbol)
+
+def coverage_snapshot(symbol):
+    db_instance = NSEDB()
+    with db_instance.read() as conn:
+        row = conn.execute(COVERAGE_QUERY + ' WHERE "Symbol" = ?', (symbol,)).fetchone()
+    return coverage_text(row[1:])
+
+def coverage_text(row):
+    return tuple('' if value is None else str(value) for value in row)
+
+def compile_store(directory=None, chunksize=500000):
+    """
+    Write the NSECACHE table out as column files, see MmapStore.
+    Everything is built in a temporary directory which then replaces directory.
+    """
+    if directory is None:
+        directory = NSEDB.working_dir + "mmap/"
+    path = Path(directory.rstrip("/"))
+    tmp_path = path.with_name(path.name + ".tmp")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+
+    query = 'SELECT "Symbol", "Date", {} FROM "NSECACHE" ORDER BY "Symbol", "Date"'.format(", ".join('"{}"'.format(c) for c in MMAP_COLUMNS))
+    index = {}
+    offset = 0
+    db_instance = NSEDB()
+    with db_instance.read() as conn:
+        # The count and the rows from one snapshot, whatever a refresh writes meanwhile.
+        conn.execute("BEGIN")
+        try:
+            total = conn.execute('SELECT COUNT(*) FROM "NSECACHE"').fetchone()[0]
+            coverage = {row[0]: coverage_text(row[1:]) for row in conn.execute(COVERAGE_QUERY + ' GROUP BY "Symbol"')}
+            logging.info("Compiling {} rows into {}".format(total, directory))
+
+            start = time.perf_counter()
+            out = {"Date": np.lib.format.open_memmap(tmp_path / "Date.npy", mode='w+', dtype='int32', shape=(total,))}
+            for column in MMAP_COLUMNS:
+                out[column] = np.lib.format.open_memmap(tmp_path / "{}.npy".format(column), mode='w+', dtype='float64', shape=(total,))
+
+            for chunk in pd.read_sql_query(query, conn, chunksize=chunksize):
+                n = len(chunk)
+                out["Date"][offset:offset + n] = chunk["Date"].to_numpy(dtype='int64')
+                for column in MMAP_COLUMNS:
+                    out[column][offset:offset + n] = chunk[column].to_numpy(dtype='float64')
+
+                # Rows are sorted by symbol: find where each run of a symbol starts. A symbol can span chunks.
+                symbols = chunk["Symbol"].to_numpy()
+                starts = np.concatenate(([0], np.flatnonzero(symbols[1:] != symbols[:-1]) + 1, [n]))
+                for i, j in zip(starts[:-1], starts[1:]):
+                    first, length = index.get(symbols[i], (offset + int(i), 0))
+                    index[symbols[i]] = (first, length + int(j - i))
+
+                offset += n
+        finally:
+            conn.execute("COMMIT")
+
+    for values in out.values():
+        values.flush()
+    del out
+
+    pd.DataFrame([(symbol, first, length) + coverage.get(symbol, ('', '', '0')) for symbol, (first, length) in index.items()],
+            columns=["Symbol", "offset", "length"] + COVERAGE_COLUMNS).to_csv(tmp_path / "index.csv", index=False)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+    logging.info("Compiled {} symbols, {} rows in {:.1f}s".format(len(index), total, time.perf_counter() - start))
+
+def main():
+    backtest.setup_logging()
+
+    parser = argparse.ArgumentParser(
+            description="""
+            ==============================
+            Memory-mapped nsecache store
+            ==============================
+            """
+            )
+
+    parser.add_argument('--compile', help='compile nsecache.db into memory-mapped column files', action='store_true', default=False)
+
+    args = parser.parse_args()
+
+    if args.compile:
+        compile_store()
+
+
+if __name__ == "__main__":
+    main()
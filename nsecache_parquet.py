@@ -0,0 +1,166 @@
+#!/home/mansuman/venv/bin/python
+import os
+import sys
+import time
+import argparse
+import logging
+from pathlib import Path
+import pandas as pd
+
+import backtest
+from backtest import NSEDB, NSECACHE_COLUMNS, SqliteStore
+
+
+"""
+Columnar price history store.
+Every symbol is one file under .nsecache/parquet/ (Parquet, or Arrow IPC/Feather
+with format='feather'), with the NSECACHE columns. A symbol's history is read with
+one vectorized read of just the columns asked for. Needs pyarrow.
+Select it with backtest.use_store('parquet') or --store parquet. Fill it from
+nsecache.db first with:
+    ./nsecache_parquet.py --migrate
+The coverage table in nsecache.db is shared by all stores, so a symbol that was
+never migrated is taken as fetched and reads as empty.
+"""
+class ParquetStore:
+    def __init__(self, directory=None, format='parquet'):
+        if directory is None:
+            directory = NSEDB.working_dir + "parquet/"
+        self.directory = directory
+        self.format = format
+        # backtest.use_store() name of this store
+        self.name = format
+
+    def path(self, symbol):
+        return Path(self.directory) / "{}.{}".format(symbol, self.format)
+
+    def read_file(self, path, columns=None):
+        if self.format == 'feather':
+            return pd.read_feather(path, columns=columns)
+        return pd.read_parquet(path, columns=columns)
+
+    def read_symbol(self, symbol, columns=None):
+        if columns is None:
+            columns = NSECACHE_COLUMNS
+        columns = ["Date"] + [c for c in columns if c != "Date"]
+
+        path = self.path(symbol)
+        if path.is_file() is False:
+            df = pd.DataFrame(columns=columns)
+        else:
+            df = self.read_file(path, columns)
+
+        df.set_index('Date', inplace=True)
+        df.index = pd.to_datetime(df.index)
+        return df
+
+    def write(self, data_df):
+        """
+        Merge a get_history() frame into the symbol files. Rows of a date we already
+        have are replaced. Each file is rewritten in full and renamed into place.
+        Files always get all NSECACHE_COLUMNS, NaN where the frame (an old bhavcopy,
+        a fake source) has none, so that any of them can be read.
+        """
+        if data_df.empty:
+            return 0
+
+        Path(self.directory).mkdir(parents=True, exist_ok=True)
+
+        df = data_df.reset_index()
+        df['Date'] = pd.to_datetime(df['Date'])
+
+        for symbol, rows in df.groupby('Symbol', sort=False, observed=True):
+            rows = rows.reindex(columns=NSECACHE_COLUMNS)
+            path = self.path(symbol)
+            # The whole file, also one written before it got all the columns
+            old = self.read_file(path).reindex(columns=NSECACHE_COLUMNS) if path.is_file() else None
+            merged = pd.concat([old, rows]) if old is not None and not old.empty else rows
+            merged = merged.drop_duplicates('Date', keep='last').sort_values('Date').reset_index(drop=True)
+
+            tmp_path = path.with_name(path.name + ".tmp")
+            if self.format == 'feather':
+                merged.to_feather(tmp_path)
+            else:
+                merged.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, path)
+
+        return len(df)
+
+    def read_panel(self, symbols, fields, start_date, end_date):
+        return backtest.stack_panel(self, symbols, fields, start_date, end_date)
+
+    def invalidate(self, symbol):
+        # Files are read on every read_symbol(), there is nothing to forget.
+        pass
+
+def cached_symbols():
+    db_instance = NSEDB()
+    with db_instance.read() as conn:
+        return [row[0] for row in conn.execute('SELECT DISTINCT "Symbol" FROM "NSECACHE" ORDER BY "Symbol"')]
+
+def migrate(store):
+    """
+    Copy every symbol of the NSECACHE table into store.
+    """
+    sqlite_store = SqliteStore()
+    symbols = cached_symbols()
+    logging.info("Migrating {} symbols to {}".format(len(symbols), store.directory))
+
+    rows = 0
+    start = time.perf_counter()
+    for symbol in symbols:
+        rows += store.write(sqlite_store.read_symbol(symbol))
+
+    elapsed = time.perf_counter() - start
+    logging.info("Migrated {} rows in {:.1f}s".format(rows, elapsed))
+
+def benchmark(store, count):
+    """
+    Time reading the full history of count symbols from SQLite and from store,
+    with all columns and with just the columns the backtest needs.
+    """
+    symbols = cached_symbols()[:count]
+    sqlite_store = SqliteStore()
+
+    for columns in (None, ["Open", "High", "Low", "Close", "Volume"]):
+        for s in (sqlite_store, store):
+            start = time.perf_counter()
+            rows = 0
+            for symbol in symbols:
+                rows += len(s.read_symbol(symbol, columns))
+            elapsed = time.perf_counter() - start
+            print("{:8} {:9} {:4} symbols {:8} rows {:8.2f} ms/symbol".format(
+                s.name, "all" if columns is None else "ohlcv", len(symbols), rows, 1000 * elapsed / max(len(symbols), 1)))
+
+def main():
+    backtest.setup_logging()
+
+    parser = argparse.ArgumentParser(
+            description="""
+            ==============================
+            Columnar nsecache store
+            ==============================
+            """
+            )
+
+    parser.add_argument('--migrate', help='copy nsecache.db into per-symbol files', action='store_true', default=False)
+    parser.add_argument('--benchmark', metavar='symbols', help='compare read times against SQLite for this many symbols', type=int, default=0)
+    parser.add_argument('--format', metavar='format', help='parquet or feather', type=str, default='parquet')
+
+    args = parser.parse_args()
+
+    if args.format not in ('parquet', 'feather'):
+        print("--format should be parquet or feather.")
+        sys.exit(0)
+
+    store = ParquetStore(format=args.format)
+
+    if args.migrate:
+        migrate(store)
+
+    if args.benchmark:
+        benchmark(store, args.benchmark)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,402 @@
+#!/home/mansuman/venv/bin/python
+import sys
+import json
+import time
+import argparse
+import logging
+import contextlib
+import multiprocessing
+from queue import Queue
+from collections import Counter
+from pathlib import Path
+from datetime import datetime as dt
+import pandas as pd
+
+import backtest
+import backtest_results
+import nse_fetch
+from backtest import BacktestError, SchemaError
+from backtest_stats import stats, SlowestProfiles
+
+
+"""
+Every batch writes the stats of its stages and counters (see backtest_stats) to
+stats_file. With --profile N the N slowest rows are run under cProfile and
+their profiles are written to profile_dir.
+"""
+stats_file = "../data/backtest_stats.json"
+profile_dir = "../data/profiles/"
+
+# Rows of the signal file read at a time
+CHUNK_ROWS = 50000
+
+# SlowestProfiles of the batch, None when not profiling
+profiles = None
+
+def profiled(label):
+    if profiles is None:
+        return contextlib.nullcontext()
+    return profiles.profile(label)
+
+def backtest_row(symbol, date, price, type, write=True, history=None):
+    """
+    Backtest one row of the signal file, the same way `./backtest.py` does it.
+    Returns (results row, None), or (None, error text) if the row failed.
+    With write=True a failure is recorded in the run manifest too.
+    """
+    print(symbol, date, price)
+    logging.info("Starting backtesting for symbol {} date {} buy price {}".format(symbol, date, price))
+
+    try:
+        with stats.stage('signal'), profiled("{}_{}".format(symbol, date)):
+            return backtest.run_backtest(symbol, date, price, type, write, history), None
+    except BacktestError as e:
+        logging.error("Backtesting failed for symbol {} date {}: {}".format(symbol, date, str(e)))
+        error = str(e)
+    except SchemaError:
+        # Not this row's fault: no row can run until the cache is migrated.
+        raise
+    except Exception as e:
+        # Anything else is a bug for this row only. Keep going with the rest of the file.
+        logging.exception("Unexpected error while backtesting symbol {} date {}: {}".format(symbol, date, str(e)))
+        error = repr(e)
+
+    if write:
+        record_failure(symbol, date, type, error)
+    return None, error
+
+def record_failure(symbol, date, type, error):
+    backtest.results.add_failure(symbol, dt.strptime(date, '%d-%m-%Y').date(), type, backtest.side_params(type), error)
+
+def symbol_span(symbol, dates):
+    """
+    (start, end) covering the backtest windows of all dates of symbol.
+    """
+    entry_dates = [dt.strptime(date, '%d-%m-%Y').date() for date in dates]
+    start = min(entry_dates).strftime('%d-%m-%Y')
+    end = backtest.backtest_end_date(max(entry_dates).strftime('%d-%m-%Y'))
+    return start, end
+
+def symbol_history(symbol, dates):
+    """
+    One SymbolHistory covering the backtest windows of all dates of symbol.
+    """
+    start, end = symbol_span(symbol, dates)
+    return backtest.SymbolHistory(symbol, start, end)
+
+def backtest_symbol(task):
+    """
+    Backtest all dates of one symbol, reading its price history from the cache once.
+    Returns (symbol, date, results row, error) of every date, see backtest_row().
+    """
+    symbol, dates, type, write = task
+    history = symbol_history(symbol, dates)
+    return [(symbol, date) + backtest_row(symbol, date, 0, type, write, history) for date in dates]
+
+def group_by_symbol(df, type, write):
+    # Tasks for backtest_symbol(), in the order the symbols first appear in the file.
+    return [(symbol, list(group['date']), type, write) for symbol, group in df.groupby('symbol', sort=False)]
+
+def pending_tasks(tasks, type, retry=False, running=()):
+    """
+    Drop the dates the run manifest has as done (and as failed, unless retry) from tasks,
+    so a batch that was stopped carries on where it got to. A date which is in
+    the tasks twice, or in running (the (symbol, date) still being backtested),
+    is dropped as a duplicate.
+    Returns the tasks left and {status: rows skipped}.
+    """
+    runs = backtest.results.runs(type, backtest.side_params(type), [symbol for symbol, dates, type, write in tasks])
+    pending = []
+    skipped = Counter()
+    for symbol, dates, type, write in tasks:
+        todo = []
+        for date in dates:
+            status = runs.get((symbol, dt.strptime(date, '%d-%m-%Y').date()))
+            if status == backtest_results.RUN_DONE or (status == backtest_results.RUN_FAILED and not retry):
+                skipped[status] += 1
+            elif date in todo or (symbol, date) in running:
+                skipped['duplicate'] += 1
+            else:
+                todo.append(date)
+        if todo:
+            pending.append((symbol, todo, type, write))
+
+    return pending, skipped
+
+def prefetch_tasks(tasks, fetch_workers):
+    """
+    Download what the cache is missing for all tasks at once, fetch_workers
+    downloads at a time (see backtest.prefetch()), instead of one symbol at a time
+    in the middle of the backtests.
+    Returns the set of symbols whose history was downloaded and {symbol: error} of the downloads that failed.
+    """
+    spans = [(symbol,) + symbol_span(symbol, dates) for symbol, dates, type, write in tasks]
+    with stats.stage('prefetch'):
+        fetched, failed = backtest.prefetch(spans, workers=fetch_workers)
+    if failed:
+        logging.error("Could not fetch {} symbols: {}".format(len(failed), ", ".join(sorted(failed))))
+    return fetched, failed
+
+"""
+Signal file pipeline.
+The signal file is never read whole. read_signals() reads chunk_rows rows at a
+time, parse_signals() drops the rows without a symbol or a dd-mm-yyyy date,
+and batch_tasks() groups each chunk by symbol, drops what is done and prefetches
+what the cache is missing. These are generators, so a chunk is only read when
+the backtests have taken the tasks of the one before: memory depends on
+chunk_rows, not on the size of the file. The history of a symbol whose rows are
+spread over several chunks is read once per chunk.
+"""
+def read_signals(backtest_file, chunk_rows=CHUNK_ROWS):
+    """
+    The symbol and date columns of the signal file, as text, chunk_rows rows at a time.
+    """
+    with pd.read_csv(backtest_file, usecols=['symbol', 'date'], dtype=str, keep_default_na=False, chunksize=chunk_rows) as reader:
+        for chunk in reader:
+            yield chunk
+
+def parse_signals(chunks, totals):
+    """
+    Chunks without the invalid rows (logged), with the dates as dd-mm-yyyy.
+    Counts the rows and the invalid rows in totals.
+    """
+    for chunk in chunks:
+        symbols = chunk['symbol'].str.strip()
+        dates = pd.to_datetime(chunk['date'].str.strip(), format='%d-%m-%Y', errors='coerce')
+        valid = (symbols != '') & dates.notna()
+
+        totals['rows'] += len(chunk)
+        invalid = chunk[~valid]
+        if not invalid.empty:
+            totals['invalid'] += len(invalid)
+            for line, symbol, date in zip(invalid.index + 2, invalid['symbol'], invalid['date']):
+                logging.error("Skipping line {} of the signal file, symbol {!r} date {!r}".format(line, symbol, date))
+
+        yield pd.DataFrame({'symbol': symbols[valid], 'date': dates[valid].dt.strftime('%d-%m-%Y')})
+
+def batch_tasks(backtest_file, type, retry=False, fetch_workers=nse_fetch.FETCH_WORKERS, chunk_rows=CHUNK_ROWS, totals=None, running=()):
+    """
+    The tasks for backtest_symbol() of each chunk of the signal file, which are not
+    done yet (see pending_tasks()) and whose history is in the cache (see prefetch_tasks()),
+    with the set of symbols downloaded for the chunk.
+    The results of a chunk are flushed before the next chunk is looked up, so a
+    row which comes again later is skipped. A symbol whose download failed is not
+    downloaded again in this batch, see backtest.failed_fetches.
+    Counts the rows read, invalid and skipped in totals.
+    """
+    totals = Counter() if totals is None else totals
+    backtest.failed_fetches.clear()
+    for df in parse_signals(read_signals(backtest_file, chunk_rows), totals):
+        tasks, skipped = pending_tasks(group_by_symbol(df, type, True), type, retry, running)
+        totals.update(skipped)
+        fetched, failed = prefetch_tasks([task for task in tasks if task[0] not in backtest.failed_fetches], fetch_workers)
+        backtest.failed_fetches.update((symbol, str(error)) for symbol, error in failed.items())
+        yield tasks, fetched
+        backtest.results.flush()
+
+def run_batch(backtest_file, type, workers=1, fetch_workers=nse_fetch.FETCH_WORKERS, retry=False, profile=0, chunk_rows=CHUNK_ROWS):
+    """
+    Backtest every row of the signal file that is not done yet, see pending_tasks().
+    pandas/nsepy are imported once and all rows share one NSEDB connection.
+    The file is read chunk_rows rows at a time, see batch_tasks(). Price history
+    missing from the cache is downloaded before the backtests of a chunk start.
+    Rows are backtested symbol by symbol, so the results come out grouped by symbol.
+    With workers > 1 the rows are spread over a process pool, see run_batch_parallel().
+    With profile > 0 the profile slowest rows are profiled, see write_stats().
+    """
+    global profiles
+    profiles = SlowestProfiles(profile) if profile > 0 else None
+    started = time.perf_counter()
+
+    print("Opening backtesting data...")
+    totals = Counter()
+
+    if workers > 1:
+        # (symbol, date) the workers have not given back yet, see pending_tasks().
+        running = set()
+        done, failed = run_batch_parallel(batch_tasks(backtest_file, type, retry, fetch_workers, chunk_rows, totals, running),
+                type, workers, profile, running=running)
+    else:
+        done = 0
+        failed = 0
+        for tasks, fetched in batch_tasks(backtest_file, type, retry, fetch_workers, chunk_rows, totals):
+            for task in tasks:
+                for symbol, date, row, error in backtest_symbol(task):
+                    if row is not None:
+                        done += 1
+                    else:
+                        failed += 1
+
+    backtest.results.flush()
+
+    skipped = totals[backtest_results.RUN_DONE] + totals[backtest_results.RUN_FAILED] + totals['duplicate']
+    logging.info("Batch {} finished: {} rows, {} backtested, {} failed, {} invalid, {} skipped".format(
+        backtest_file, totals['rows'], done, failed, totals['invalid'], skipped))
+    if totals[backtest_results.RUN_FAILED]:
+        logging.info("{} rows which failed before were skipped (use --retry)".format(totals[backtest_results.RUN_FAILED]))
+    seconds = time.perf_counter() - started
+    batch = {'file': backtest_file, 'type': type, 'workers': workers, 'rows': totals['rows'], 'done': done, 'failed': failed,
+            'invalid': totals['invalid'], 'skipped': skipped, 'seconds': seconds, 'rows_per_s': (done + failed) / seconds if seconds > 0 else 0.0}
+    write_stats(batch, backtest.price_cache.stats() if workers <= 1 else None)
+
+def write_stats(batch, price_cache=None):
+    """
+    Write the batch totals, the stage timings and counters (of all workers) and,
+    for a serial batch, the price cache stats to stats_file, and dump the profiles.
+    """
+    summary = dict(batch=batch, **stats.summary())
+    if price_cache is not None:
+        summary['price_cache'] = price_cache
+
+    Path(stats_file).parent.mkdir(parents=True, exist_ok=True)
+    with open(stats_file, "w") as fh:
+        json.dump(summary, fh, indent=2, default=str)
+
+    for name, stage in summary['stages'].items():
+        logging.info("Stage {:18} {:8} x  total {:8.2f}s  p50 {:8.3f} ms  p99 {:8.3f} ms".format(
+            name, stage['count'], stage['total_s'], stage['p50_ms'], stage['p99_ms']))
+    logging.info("Counters: {}".format(summary['counters']))
+    if price_cache is not None:
+        logging.info("Price cache: {}".format(price_cache))
+    logging.info("Stats written to {}".format(stats_file))
+
+    if profiles is not None:
+        profiles.dump(profile_dir)
+
+"""
+Parallel batch.
+Every symbol goes to one worker, which reads the symbol's history once (see
+backtest_symbol()). Workers open the cache read-only and send their result rows
+back; only the parent writes the results store.
+Workers can not add to the cache. The parent fetches what a chunk is missing
+before its tasks go out, so a symbol whose download failed fails in the workers
+too. The parent counts the downloads of every symbol and sends that version with
+each task; a worker whose copy of a symbol (price_cache, mmap view) is of an
+older version drops it before backtesting.
+At most max_pending tasks are out at a time. The parent only reads the next
+chunk of the signal file once the workers have caught up.
+"""
+# {symbol: version} of what this worker has read, see backtest_symbol_worker()
+symbol_versions = {}
+
+def init_worker(store_name, profile=0):
+    global profiles
+    backtest.setup_logging()
+    backtest.NSEDB.read_only = True
+    backtest.use_store(store_name)
+    profiles = SlowestProfiles(profile) if profile > 0 else None
+
+def backtest_symbol_worker(task, version=0):
+    """
+    backtest_symbol() in a worker, with the stats and profiles it took for the parent to merge.
+    version is how many times the parent has downloaded the symbol so far.
+    """
+    symbol = task[0]
+    if symbol_versions.get(symbol, 0) != version:
+        backtest.invalidate_symbol(symbol)
+        symbol_versions[symbol] = version
+    rows = backtest_symbol(task)
+    return rows, stats.take(), profiles.take() if profiles is not None else []
+
+def run_batch_parallel(task_chunks, type, workers, profile=0, max_pending=None, running=None):
+    """
+    Backtest the tasks of task_chunks (see batch_tasks()) in workers processes.
+    running gets the (symbol, date) of the tasks which are out.
+    Returns the number of rows done and failed.
+    """
+    # Bring the cache schema up to date while we can still write, and don't carry
+    # open connections into the workers.
+    backtest.NSEDB()
+    backtest.NSEDB.reset()
+    backtest.results.close()
+
+    if max_pending is None:
+        max_pending = 4 * workers
+    logging.info("Backtesting with {} workers, at most {} symbols at a time".format(workers, max_pending))
+
+    done = 0
+    failed = 0
+    # Results (or the exception) of the tasks, put there by the pool's result thread
+    finished = Queue()
+    pending = 0
+    # {symbol: downloads so far}, see backtest_symbol_worker()
+    versions = Counter()
+    running = set() if running is None else running
+
+    def collect():
+        nonlocal done, failed, pending
+        out = finished.get()
+        pending -= 1
+        if isinstance(out, BaseException):
+            raise out
+
+        rows, worker_stats, worker_profiles = out
+        stats.merge(worker_stats)
+        if profiles is not None:
+            profiles.merge(worker_profiles)
+        for symbol, date, row, error in rows:
+            running.discard((symbol, date))
+            if row is None:
+                record_failure(symbol, date, type, error)
+                failed += 1
+                continue
+            backtest.results.add(row)
+            done += 1
+
+    with multiprocessing.Pool(workers, initializer=init_worker, initargs=(backtest.store.name, profile)) as pool:
+        for tasks, fetched in task_chunks:
+            versions.update(fetched)
+            tasks = [(symbol, dates, type, False) for symbol, dates, task_type, write in tasks]
+            # Biggest groups first, so that no worker is left alone with a big group at the end of a chunk.
+            tasks.sort(key=lambda task: len(task[1]), reverse=True)
+            for task in tasks:
+                while pending >= max_pending:
+                    collect()
+                pool.apply_async(backtest_symbol_worker, (task, versions[task[0]]), callback=finished.put, error_callback=finished.put)
+                running.update((task[0], date) for date in task[1])
+                pending += 1
+
+        while pending:
+            collect()
+
+    backtest.results.flush()
+
+    return done, failed
+
+def main():
+    global stats_file
+    backtest.setup_logging()
+
+    parser = argparse.ArgumentParser(
+            description="""
+            ==============================
+            Backtest a signal file
+            ==============================
+            """
+            )
+
+    parser.add_argument('--file', metavar='file', help='signal csv file with symbol and date columns', type=str, default="../data/backtest_data.csv")
+    parser.add_argument('--type', metavar='type', help='buy or sell', type=str, default='buy')
+    parser.add_argument('--workers', metavar='workers', help='number of worker processes', type=int, default=1)
+    parser.add_argument('--fetch_workers', metavar='fetch_workers', help='concurrent downloads for symbols missing from the cache', type=int, default=nse_fetch.FETCH_WORKERS)
+    parser.add_argument('--store', metavar='store', help='price history store: sqlite, parquet, feather or mmap', type=str, default='sqlite')
+    parser.add_argument('--retry', help='backtest the rows which failed before again', action='store_true', default=False)
+    parser.add_argument('--profile', metavar='profile', help='profile the N slowest rows into {}'.format(profile_dir), type=int, default=0)
+    parser.add_argument('--stats', metavar='path', help='where to write the batch stats (default {})'.format(stats_file), type=str, default=stats_file)
+    parser.add_argument('--chunk_rows', metavar='chunk_rows', help='rows of the signal file read at a time (default {})'.format(CHUNK_ROWS), type=int, default=CHUNK_ROWS)
+    parser.add_argument('--cache_mb', metavar='cache_mb', help='memory for parsed price history, per process (default 256)', type=int, default=256)
+
+    args = parser.parse_args()
+
+    if args.type not in ('buy', 'sell'):
+        print("--type should be buy or sell.")
+        sys.exit(0)
+
+    backtest.use_store(args.store)
+    backtest.price_cache.max_bytes = args.cache_mb * 1024 * 1024
+    stats_file = args.stats
+    run_batch(args.file, args.type, args.workers, args.fetch_workers, args.retry, args.profile, args.chunk_rows)
+
+
+if __name__ == "__main__":
+    main()
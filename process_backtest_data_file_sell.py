@@ -1,22 +1,8 @@
 #!/home/mansuman/venv/bin/python
-import pandas as pd
-import sys
-import subprocess
+import backtest
+from process_backtest_data_file import run_batch
 
 backtest_file = "../data/backtest_sell.csv"
-print("Opening backtesting data...")
-df = pd.read_csv(backtest_file)
 
-print(df.columns)
-
-
-for index, row in df.iterrows():
-    proc = subprocess.Popen(
-            ['./backtest.py', '--date', row['date'], '--symbol', row['symbol'], '--price', '0', '--type', 'sell'],
-            stdout=subprocess.PIPE)
-
-    out, err = proc.communicate()
-    print (out.decode('utf-8'))
-
-    # print("================================")
-    # print('./backtest.py', '--date', row['date'], '--symbol', row['symbol'], '--price', '0')
+backtest.setup_logging()
+run_batch(backtest_file, 'sell')
@@ -0,0 +1,245 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from backtest_kernel import evaluate_buy, evaluate_sell, sweep_buy, sweep_sell, price_arrays
+
+
+"""
+Equivalence of backtest_kernel with the iterrows() loops it replaced, and of the
+sweep with evaluate_buy/evaluate_sell.
+loop_buy/loop_sell are the loops of backtest_buy/backtest_sell as they were,
+returning their variables instead of logging them, and are the oracle here.
+    python -m pytest -q test_backtest_kernel.py
+"""
+def loop_buy(df, price, target_15, target_20, stoploss):
+    max_correction = price
+    result_15 = None
+    result_20 = None
+    time_taken = -1
+    time_taken_15 = 0
+    time_taken_20 = 0
+
+    target_hit_15 = False
+    target_hit_20 = False
+    sl_hit = False
+
+    high_in_3_months = 0
+    high_in_6_months = 0
+    for index, row in df.iterrows():
+        low = row['Low']
+        high = row['High']
+        close = row['Close']
+
+        time_taken += 1
+        if time_taken == 0:
+            continue
+
+        if target_hit_15 is False and close < stoploss:
+            sl_hit = True
+            result_15 = "SL hit"
+            result_20 = "SL hit"
+
+        if sl_hit is False and target_hit_15 is False:
+            if high > target_15:
+                result_15 = "Target Hit"
+                target_hit_15 = True
+                time_taken_15 = time_taken
+
+        if sl_hit is False and target_hit_20 is False:
+            if high > target_20:
+                result_20 = "Target Hit"
+                target_hit_20 = True
+                time_taken_20 = time_taken
+
+        if low < max_correction and target_hit_15 is False:
+            max_correction = low
+
+        if high > high_in_6_months:
+            high_in_6_months = high
+
+        if time_taken < 90 and high > high_in_3_months:
+            high_in_3_months = high
+
+    return {
+        'target_hit_15': target_hit_15,
+        'target_hit_20': target_hit_20,
+        'sl_hit': sl_hit,
+        'result_15': result_15,
+        'result_20': result_20,
+        'time_taken_15': time_taken_15,
+        'time_taken_20': time_taken_20,
+        'max_correction': max_correction,
+        'high_in_3_months': high_in_3_months,
+        'high_in_6_months': high_in_6_months,
+    }
+
+def loop_sell(df, price, target_15, target_20, stoploss):
+    max_correction = price
+    result_15 = None
+    result_20 = None
+    time_taken = -1
+    time_taken_15 = 0
+    time_taken_20 = 0
+
+    target_hit_15 = False
+    target_hit_20 = False
+    sl_hit = False
+
+    low_in_3_months = price
+    low_in_6_months = price
+    for index, row in df.iterrows():
+        low = row['Low']
+        high = row['High']
+        close = row['Close']
+
+        time_taken += 1
+        if time_taken == 0:
+            continue
+
+        if target_hit_15 is False and close > stoploss:
+            sl_hit = True
+            result_15 = "SL hit"
+            result_20 = "SL hit"
+
+        if sl_hit is False and target_hit_15 is False:
+            if low < target_15:
+                result_15 = "Target Hit"
+                target_hit_15 = True
+                time_taken_15 = time_taken
+
+        if sl_hit is False and target_hit_20 is False:
+            if low < target_20:
+                result_20 = "Target Hit"
+                target_hit_20 = True
+                time_taken_20 = time_taken
+
+        if high > max_correction:
+            max_correction = high
+
+        if low < low_in_6_months:
+            low_in_6_months = low
+
+        if time_taken < 90 and low < low_in_3_months:
+            low_in_3_months = low
+
+    return {
+        'target_hit_15': target_hit_15,
+        'target_hit_20': target_hit_20,
+        'sl_hit': sl_hit,
+        'result_15': result_15,
+        'result_20': result_20,
+        'time_taken_15': time_taken_15,
+        'time_taken_20': time_taken_20,
+        'max_correction': max_correction,
+        'low_in_3_months': low_in_3_months,
+        'low_in_6_months': low_in_6_months,
+    }
+
+# Thresholds of backtest_buy/backtest_sell
+BUY = (1.03, 1.05, .95)
+SELL = (.97, .95, 1.05)
+
+def frame(high, low, close):
+    return pd.DataFrame({'High': high, 'Low': low, 'Close': close}, dtype='float64')
+
+def check(df, type, price):
+    if type == 'buy':
+        loop, evaluate, (t15, t20, sl) = loop_buy, evaluate_buy, BUY
+    else:
+        loop, evaluate, (t15, t20, sl) = loop_sell, evaluate_sell, SELL
+
+    expected = loop(df, price, price * t15, price * t20, price * sl)
+    got = evaluate(*price_arrays(df), price, price * t15, price * t20, price * sl)
+    for name, value in expected.items():
+        assert got[name] == value, "{}: kernel {!r}, loop {!r}".format(name, got[name], value)
+
+def random_frame(rng, n, price):
+    close = price * np.cumprod(1 + rng.normal(0, 0.02, n))
+    high = close * (1 + rng.uniform(0, 0.03, n))
+    low = close * (1 - rng.uniform(0, 0.03, n))
+    for a in (high, low, close):
+        a[rng.random(n) < 0.05] = np.nan
+    return frame(high, low, close)
+
+@pytest.mark.parametrize('type', ['buy', 'sell'])
+def test_random_windows(type):
+    rng = np.random.default_rng(3)
+    for _ in range(500):
+        check(random_frame(rng, int(rng.integers(0, 161)), 100.0), type, 100.0)
+
+@pytest.mark.parametrize('type', ['buy', 'sell'])
+def test_empty_window(type):
+    check(frame([], [], []), type, 100.0)
+
+@pytest.mark.parametrize('type', ['buy', 'sell'])
+def test_one_bar_window(type):
+    # Day 0 is the entry and never hits, however far it is from the price.
+    check(frame([200.0], [1.0], [1.0]), type, 100.0)
+    check(frame([100.0], [100.0], [100.0]), type, 100.0)
+
+def test_stoploss_and_target_same_day_buy():
+    # High beyond both targets, Close below the stoploss: the stoploss wins.
+    df = frame([100, 110, 100], [100, 90, 100], [100, 94, 100])
+    check(df, 'buy', 100.0)
+    assert evaluate_buy(*price_arrays(df), 100.0, 103.0, 105.0, 95.0)['result_15'] == "SL hit"
+
+def test_stoploss_and_target_same_day_sell():
+    df = frame([100, 110, 100], [100, 90, 100], [100, 106, 100])
+    check(df, 'sell', 100.0)
+    assert evaluate_sell(*price_arrays(df), 100.0, 97.0, 95.0, 105.0)['result_15'] == "SL hit"
+
+def test_stoploss_after_target_15():
+    # The stoploss stops counting once the 15% target is hit.
+    check(frame([100, 104, 100, 106], [100, 100, 90, 100], [100, 100, 90, 100]), 'buy', 100.0)
+    check(frame([100, 100, 110, 100], [100, 96, 100, 94], [100, 100, 110, 100]), 'sell', 100.0)
+
+@pytest.mark.parametrize('type', ['buy', 'sell'])
+@pytest.mark.parametrize('bar', [88, 89, 90, 91])
+def test_3_months_boundary(type, bar):
+    # Bars 1..89 are the 3 months window: a spike on bar 89 counts, on bar 90 it does not.
+    n = 120
+    high = np.full(n, 100.5)
+    low = np.full(n, 99.5)
+    close = np.full(n, 100.0)
+    high[bar] = 102.0
+    low[bar] = 98.0
+    check(frame(high, low, close), type, 100.0)
+
+def check_sweep(df, type, price, targets, stoplosses):
+    # Every (target, stoploss) of the sweep against evaluate_buy/evaluate_sell with that pair.
+    high, low, close = price_arrays(df)
+    if type == 'buy':
+        target_prices, stoploss_prices = price * (1 + targets), price * (1 - stoplosses)
+        sweep, evaluate = sweep_buy, evaluate_buy
+    else:
+        target_prices, stoploss_prices = price * (1 - targets), price * (1 + stoplosses)
+        sweep, evaluate = sweep_sell, evaluate_sell
+
+    out = sweep(high, low, close, target_prices, stoploss_prices)
+    for i, target in enumerate(target_prices):
+        for j, stoploss in enumerate(stoploss_prices):
+            expected = evaluate(high, low, close, price, target, target, stoploss)
+            assert out['target_hit'][i, j] == expected['target_hit_15']
+            assert out['sl_hit'][i, j] == expected['sl_hit']
+            assert out['time_taken'][i, j] == expected['time_taken_15']
+
+SWEEP_TARGETS = np.array([0.01, 0.03, 0.05, 0.1])
+SWEEP_STOPLOSSES = np.array([0.02, 0.05])
+
+@pytest.mark.parametrize('type', ['buy', 'sell'])
+def test_sweep_random_windows(type):
+    rng = np.random.default_rng(3)
+    for _ in range(500):
+        check_sweep(random_frame(rng, int(rng.integers(0, 161)), 100.0), type, 100.0, SWEEP_TARGETS, SWEEP_STOPLOSSES)
+
+@pytest.mark.parametrize('type', ['buy', 'sell'])
+def test_sweep_empty_and_one_bar_windows(type):
+    # A signal on the last cached session has a window of day 0 only.
+    check_sweep(frame([], [], []), type, 100.0, SWEEP_TARGETS, SWEEP_STOPLOSSES)
+    check_sweep(frame([200.0], [1.0], [1.0]), type, 100.0, SWEEP_TARGETS, SWEEP_STOPLOSSES)
+
+@pytest.mark.parametrize('type', ['buy', 'sell'])
+def test_sweep_stoploss_and_target_same_day(type):
+    close = 94.0 if type == 'buy' else 106.0
+    check_sweep(frame([100, 110, 100], [100, 90, 100], [100, close, 100]), type, 100.0, SWEEP_TARGETS, SWEEP_STOPLOSSES)